@@ -0,0 +1,232 @@
+#
+################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2026 Curt Timmerman
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+#
+# Generation pipeline benchmark with synthetic payloads and fleets
+#
+# Run from the repository directory:
+#   PYTHONPATH=. python benchmarks/bench_generate.py --fleets 10 100 1000
+#
+# Only public calls are timed (load_json_sensor_ids, generate, render) so
+# the same script runs against older versions. GenStats stage timers are
+# added when the version has them. Results are written as json so runs of
+# different versions can be compared.
+#
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+
+import ha_yaml_gen
+from ha_yaml_gen import HaYamlGen
+
+# optional in older versions
+GenStats = getattr (ha_yaml_gen, "GenStats", None)
+
+################################################################################
+# Synthetic payloads
+################################################################################
+
+def wide_payload (width = 200) :
+    # many sensors at the top level
+    payload = {}
+    for key_idx in range (width) :
+        if key_idx % 4 == 0 :
+            payload ["text_" + str (key_idx)] = "value"
+        elif key_idx % 4 == 1 :
+            payload ["flag_" + str (key_idx)] = True
+        else :
+            payload ["value_" + str (key_idx)] = key_idx * 1.5
+    return payload
+
+def deep_payload (depth = 12, leaves = 4) :
+    # device -> channel -> metric ... nesting, a few sensors at each level
+    payload = {}
+    level = payload
+    for level_idx in range (depth) :
+        for leaf_idx in range (leaves) :
+            level ["metric_" + str (level_idx) + "_" + str (leaf_idx)] = leaf_idx
+        level ["level_" + str (level_idx + 1)] = {}
+        level = level ["level_" + str (level_idx + 1)]
+    return payload
+
+def array_payload (arrays = 20, length = 50) :
+    # many list values
+    payload = {"nickname" : "array_device"}
+    for array_idx in range (arrays) :
+        payload ["series_" + str (array_idx)] = [value_idx * 0.5
+                                                 for value_idx in range (length)]
+    payload ["readings"] = {"temperature" : 21.5, "humidity" : 40.0}
+    return payload
+
+PAYLOADS = {
+    "wide" : wide_payload ,
+    "deep" : deep_payload ,
+    "arrays" : array_payload
+    }
+
+################################################################################
+# Synthetic templates, every sensor is used once
+################################################################################
+
+def build_templates (gen, template_dir) :
+    ha_lines = []
+    card_lines = ["type: vertical-stack", "cards:"]
+    for _, sensor_name in enumerate (gen.sensor_ids) :
+        ha_lines.append ('  - sensor:\n'
+                         '    - name: "{{_PACKAGE_}} ' + sensor_name + ' copy"\n'
+                         '      unique_id: "{{' + sensor_name + '_unique_id}}_copy"\n'
+                         '      state: "{{ {{' + sensor_name + '_value}} }}"\n')
+        card_lines.append ("  - type: gauge\n"
+                           "    entity: {{" + sensor_name + "_ent}}\n"
+                           "    name: '{{" + sensor_name + "_state}}'")
+    ha_file_name = os.path.join (template_dir, "bench.tmpl")
+    card_file_name = os.path.join (template_dir, "bench.card")
+    with open (ha_file_name, "w") as ha_file :
+        ha_file.write ("".join (ha_lines))
+    with open (card_file_name, "w") as card_file :
+        card_file.write ("\n".join (card_lines) + "\n")
+    gen.add_ha_template (ha_file_name)
+    gen.add_card_template (card_file_name, "bench")
+
+################################################################################
+# Benchmark
+################################################################################
+
+# result stage : GenStats timer, parts of generate ()
+STATS_STAGES = {
+    "card_pro_sensor_vars" : "sensor_vars" ,
+    "generate_mqtt_sensors" : "mqtt_sensors" ,
+    "generate_ha_templates" : "ha_templates" ,
+    "generate_cards" : "card" ,
+    "write_files" : "write"
+    }
+
+def output_bytes (output_dir) :
+    total_bytes = 0
+    for _, dir_entry in enumerate (os.scandir (output_dir)) :
+        if dir_entry.is_file () :
+            total_bytes += dir_entry.stat ().st_size
+    return total_bytes
+
+def run_case (payload_name, package_count, output_dir, workers = None) :
+    stages = {}
+    json_text = json.dumps (PAYLOADS [payload_name] ())
+    stats = None
+    if GenStats is not None :
+        stats = GenStats ()
+        gen = HaYamlGen (package = "bench_" + payload_name ,
+                         mqtt_topic_base = "bench/" ,
+                         stats = stats)
+    else :
+        gen = HaYamlGen (package = "bench_" + payload_name ,
+                         mqtt_topic_base = "bench/")
+    start_time = time.perf_counter ()
+    gen.load_json_sensor_ids (json_text)
+    stages ["load_json_sensor_ids"] = time.perf_counter () - start_time
+    template_dir = os.path.join (output_dir, "templates")
+    os.mkdir (template_dir)
+    build_templates (gen, template_dir)
+    gen.build_range_list (start = 0, count = package_count)
+    # older versions write to the current directory
+    current_dir = os.getcwd ()
+    os.chdir (output_dir)
+    try :
+        start_time = time.perf_counter ()
+        if workers is None :
+            gen.generate ()
+        else :
+            gen.generate (workers = workers)
+        stages ["generate"] = time.perf_counter () - start_time
+    finally :
+        os.chdir (current_dir)
+    if hasattr (gen, "render") :
+        # stats cover generate () only
+        gen.stats = None
+        start_time = time.perf_counter ()
+        gen.render ()
+        stages ["render"] = time.perf_counter () - start_time
+    result = {
+        "payload" : payload_name ,
+        "packages" : package_count ,
+        "sensors" : len (gen.sensor_ids) ,
+        "bytes_written" : output_bytes (output_dir) ,
+        "stages" : stages ,
+        "total" : stages ["load_json_sensor_ids"] + stages ["generate"]
+        }
+    if stats is not None :
+        timers = stats.to_dict () ["timers"]
+        for _, (stage, timer_name) in enumerate (STATS_STAGES.items ()) :
+            if timer_name in timers :
+                stages [stage] = timers [timer_name]["seconds"]
+        result ["stats"] = timers
+    return result
+
+def main () :
+    parser = argparse.ArgumentParser (description = "ha_yaml_gen generation benchmark")
+    parser.add_argument ("--payloads", nargs = "+", default = list (PAYLOADS) ,
+                         choices = list (PAYLOADS))
+    parser.add_argument ("--fleets", nargs = "+", type = int, default = [10, 100, 1000] ,
+                         help = "package counts, up to 10000")
+    parser.add_argument ("--repeat", type = int, default = 1 ,
+                         help = "runs per case, the fastest run is kept")
+    parser.add_argument ("--workers", type = int, default = None ,
+                         help = "generate () worker processes")
+    parser.add_argument ("--output", default = "bench_results.json")
+    args = parser.parse_args ()
+
+    results = []
+    for _, payload_name in enumerate (args.payloads) :
+        for _, package_count in enumerate (args.fleets) :
+            best = None
+            for _ in range (args.repeat) :
+                with tempfile.TemporaryDirectory () as output_dir :
+                    result = run_case (payload_name ,
+                                       package_count ,
+                                       output_dir ,
+                                       args.workers)
+                if best is None \
+                or result ["total"] < best ["total"] :
+                    best = result
+            print ("{:8} {:6} packages {:4} sensors {:8.3f}s".format (payload_name ,
+                                                                     package_count ,
+                                                                     best ["sensors"] ,
+                                                                     best ["total"]))
+            results.append (best)
+    with open (args.output, "w") as results_file :
+        json.dump ({
+            "timestamp" : datetime.now().strftime("%Y-%m-%d %H:%M:%S") ,
+            "python" : platform.python_version () ,
+            "platform" : platform.platform () ,
+            "results" : results
+            }, results_file, indent = 1)
+
+################################################################################
+
+if __name__ == "__main__" :
+    main ()
@@ -24,12 +24,19 @@
 ################################################################################
 #
 
+import math
+import os
+import queue
+import re
+from array import array
 import time
 from datetime import datetime
 import socket
 import netifaces
 import json
-import paho.mqtt.publish as publish
+import threading
+from collections import deque
+import paho.mqtt.client as mqtt
 import psutil
 
 # Host details
@@ -45,6 +52,11 @@ TOPIC = "hoststats/" + HOSTID
 #TOPIC = "enviro/test"
 HA_USERNAME = "ha"
 HA_PASSWORD = "hapassword"
+MQTT_KEEPALIVE = 60         # seconds
+MQTT_QUEUE_LIMIT = 360      # messages kept while the broker is unreachable
+# Readings per message. HA graphs by received time so 1 is normally right.
+# > 1 sends the latest reading with the earlier ones in a "batch" list.
+MQTT_BATCH_SIZE = 1
 
 CAPTURE_INTERVAL = 1        # sample seconds
 REPORT_INTERVAL = 10        # report seconds
@@ -58,13 +70,140 @@ MEMORY_PATH = "/proc/meminfo"
 MEMORY_USED_WARN = None
 MEMORY_USED_ALERT = None
 
+CPU_STAT_PATH = "/proc/stat"
+
+DISK_PATH = "/"
 DISK_TOTAL = None
 DISK_WARN_LEVEL = None
 DISK_ALERT_LEVEL = None
 
-next_report_time = None
+# seconds between reads per metric group, cpu times are read on every call
+SAMPLE_INTERVALS = {
+    "cpu_temp" : CAPTURE_INTERVAL ,
+    "memory" : CAPTURE_INTERVAL ,
+    "disk" : 300
+    }
+
+# readings kept per metric between reports, older ones are overwritten
+RING_SIZE = max (REPORT_INTERVAL // CAPTURE_INTERVAL, 1) * 4
+# metric : payload field prefix, summary fields are added as <prefix>_<stat>
+RING_METRICS = {
+    "cpu_temp" : "cpu_temp" ,
+    "cpu_load" : "cpu_load" ,
+    "mem_used" : "mem_used"
+    }
+
+REPORT_QUEUE_LIMIT = 16     # reports waiting for the publisher thread
+
 mqtt_payload = None
 mqtt_payload_aux = None
+mqtt_publisher = None
+stats_sampler = None
+metric_rings = None
+sample_scheduler = None
+report_queue = None
+
+################################################################################
+# class MqttPublisher
+################################################################################
+
+class MqttPublisher :
+    # One long lived broker connection. paho reconnects in its network
+    # thread; messages published while disconnected wait in a bounded
+    # queue (oldest dropped first) and are sent after reconnect.
+
+    def __init__ (self ,
+                  client_id : str ,
+                  hostname : str ,
+                  port : int ,
+                  username : str = None ,
+                  password : str = None ,
+                  queue_limit : int = MQTT_QUEUE_LIMIT ,
+                  batch_size : int = MQTT_BATCH_SIZE) :
+        self.hostname = hostname
+        self.port = port
+        self.batch_size = max (batch_size, 1)
+        self.batch = []
+        self.batch_topic = None
+        self.queue = deque (maxlen = queue_limit)
+        self.dropped = 0
+        self.connected = False
+        self.lock = threading.Lock ()
+        if hasattr (mqtt, "CallbackAPIVersion") :       # paho 2.x
+            self.client = mqtt.Client (mqtt.CallbackAPIVersion.VERSION2 ,
+                                       client_id = client_id)
+        else :
+            self.client = mqtt.Client (client_id = client_id)
+        # paho keeps qos 1 messages published while disconnected, bound it too
+        self.client.max_queued_messages_set (queue_limit)
+        if username is not None :
+            self.client.username_pw_set (username, password)
+        self.client.reconnect_delay_set (min_delay = 1, max_delay = 60)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+
+    def start (self) :
+        self.client.connect_async (self.hostname ,
+                                   self.port ,
+                                   keepalive = MQTT_KEEPALIVE)
+        self.client.loop_start ()
+
+    def stop (self) :
+        if len (self.batch) > 0 :
+            self.queue_message (self.batch_topic, self.batch_message ())
+        self.flush ()
+        # DISCONNECT goes out after the flushed messages, then the
+        # network thread ends
+        self.client.disconnect ()
+        self.client.loop_stop ()
+
+    # paho 1.x passes (client, userdata, flags, rc)
+    def on_connect (self, client, userdata, flags, reason_code, properties = None) :
+        if reason_code != 0 :
+            print ("mqtt connect failed:", reason_code)
+            return
+        self.connected = True
+        self.flush ()
+
+    def on_disconnect (self, client, userdata, *args) :
+        self.connected = False
+
+    def batch_message (self) -> str :
+        message = dict (self.batch [-1])
+        if len (self.batch) > 1 :
+            message ["batch"] = self.batch [:-1]
+        self.batch = []
+        return json.dumps (message)
+
+    def queue_message (self, topic : str, message : str) :
+        with self.lock :
+            if len (self.queue) == self.queue.maxlen :
+                self.dropped += 1
+            self.queue.append ((topic, message))
+
+    def publish (self, topic : str, payload : dict) :
+        if len (self.batch) > 0 \
+        and topic != self.batch_topic :
+            self.queue_message (self.batch_topic, self.batch_message ())
+        self.batch_topic = topic
+        self.batch.append (dict (payload))
+        if len (self.batch) < self.batch_size :
+            return
+        self.queue_message (topic, self.batch_message ())
+        self.flush ()
+
+    def flush (self) :
+        with self.lock :
+            while self.connected and len (self.queue) > 0 :
+                topic, message = self.queue [0]
+                info = self.client.publish (topic, message, qos = 1)
+                if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE :
+                    break               # paho queue full, keep it here
+                # paho owns the message now, also after MQTT_ERR_NO_CONN
+                # (it is sent again on reconnect)
+                self.queue.popleft ()
+                if info.rc != mqtt.MQTT_ERR_SUCCESS :
+                    break
 
 MEMORY_STAT_LIST = {
     "MemTotal:" : "mem_tot" ,
@@ -73,52 +212,216 @@ MEMORY_STAT_LIST = {
     "SwapTotal:" : "swap_tot" ,
     "SwapFree:" : "swap_free"
     }
-def get_memory_stats (stats) :
-    memory_data = {}
-    with open(MEMORY_PATH, "r") as f:
-        mem_stat = f.readline ()
-        while mem_stat :
-            #print (mem_stat)
-            mem_fields = mem_stat.split ()
-            if mem_fields[0] in MEMORY_STAT_LIST :
-                #print (mem_fields)
-                mem_id = MEMORY_STAT_LIST [mem_fields[0]]
-                #print (mem_id)
-                stats [mem_id] = int (mem_fields[1])
-            mem_stat = f.readline ()
-    if "mem_avail" in stats \
-    and "mem_tot" in stats :
-        stats ["mem_tot"] = stats ["mem_tot"] // 1000
-        stats ["mem_avail"] = stats ["mem_avail"] // 1000
-        stats ["mem_used"] = stats ["mem_tot"] - stats ["mem_avail"]
-        #print ("used:",stats ["mem_used"])
-    stats ["swap_used"] = stats ["swap_tot"] - stats ["swap_free"]
-    #print ("mem:", stats)
+# matches only the MEMORY_STAT_LIST lines of /proc/meminfo
+MEMORY_STAT_RE = re.compile (rb"^(" \
+                    + b"|".join (re.escape (mem_field.encode ()) \
+                                 for mem_field in MEMORY_STAT_LIST) \
+                    + rb")\s+(\d+)" ,
+                    re.MULTILINE)
+# first (aggregate) line of /proc/stat
+CPU_STAT_RE = re.compile (rb"cpu +([\d ]+)")
+MEMORY_STAT_IDS = {mem_field.encode () : mem_id \
+                    for mem_field, mem_id in MEMORY_STAT_LIST.items ()}
+
+################################################################################
+# class ProcFile
+################################################################################
+
+class ProcFile :
+    # /proc and /sys files regenerate their content on every read from
+    # offset 0, so the descriptor is opened once and re-read with preadv
+    # into the same buffer.
+
+    def __init__ (self, path : str, buffer_size : int = 4096) :
+        self.path = path
+        self.fd = os.open (path, os.O_RDONLY)
+        self.buffer = bytearray (buffer_size)
+        self.view = memoryview (self.buffer)
+
+    def read (self) -> memoryview :
+        read_len = os.preadv (self.fd, [self.buffer], 0)
+        return self.view [:read_len]
+
+    def close (self) :
+        self.view.release ()
+        os.close (self.fd)
+
+################################################################################
+# class StatsSampler
+################################################################################
+
+class StatsSampler :
+    # Each metric group is re-read only when its SAMPLE_INTERVALS time has
+    # passed, otherwise the last value is kept in self.stats. Deadlines step
+    # from the first sample time, so wake up jitter of the caller does not
+    # skip reads. self.sampled holds the groups read by the last sample ().
+
+    def __init__ (self, intervals : dict = SAMPLE_INTERVALS) :
+        self.intervals = intervals
+        self.next_sample = {group : None for group in intervals}
+        self.sampled = set ()
+        self.temp_file = ProcFile (CPU_TEMP_PATH, 64)
+        self.memory_file = ProcFile (MEMORY_PATH)
+        self.cpu_file = ProcFile (CPU_STAT_PATH)
+        self.stats = {}
+        self.disk_info = None
+
+    def due (self, group : str, now : float) -> bool :
+        next_time = self.next_sample [group]
+        if next_time is None :
+            next_time = now
+        elif now < next_time :
+            return False
+        interval = self.intervals [group]
+        next_time += interval
+        if next_time <= now :
+            # far behind, skip the passed deadlines
+            next_time += ((now - next_time) // interval + 1) * interval
+        self.next_sample [group] = next_time
+        self.sampled.add (group)
+        return True
+
+    def sample (self, now : float = None) -> dict :
+        if now is None :
+            now = time.monotonic ()
+        self.sampled = set ()
+        if self.due ("cpu_temp", now) :
+            self.stats ["cpu_temp"] = int (self.temp_file.read ()) // 1000
+        if self.due ("memory", now) :
+            self.sample_memory ()
+        if self.due ("disk", now) :
+            self.disk_info = psutil.disk_usage (DISK_PATH)
+        return self.stats
+
+    def sample_memory (self) :
+        stats = self.stats
+        for mem_field, mem_value in MEMORY_STAT_RE.findall (self.memory_file.read ()) :
+            stats [MEMORY_STAT_IDS [mem_field]] = int (mem_value)
+        if "mem_avail" in stats \
+        and "mem_tot" in stats :
+            stats ["mem_tot"] = stats ["mem_tot"] // 1000
+            stats ["mem_avail"] = stats ["mem_avail"] // 1000
+            stats ["mem_used"] = stats ["mem_tot"] - stats ["mem_avail"]
+        stats ["swap_used"] = stats ["swap_tot"] - stats ["swap_free"]
+
+    def get_cpu_times (self) :
+        parts = CPU_STAT_RE.match (self.cpu_file.read ()).group (1).split ()
+        # user, nice, system, idle, iowait, irq, softirq, steal, guest, guest_nice
+        cpu_times = [int(x) for x in parts]
+        return sum(cpu_times), cpu_times[3] # total_time, idle_time
+
+    def get_disk_usage (self) :
+        if self.disk_info is None :
+            self.disk_info = psutil.disk_usage (DISK_PATH)
+        return self.disk_info
+
+    def close (self) :
+        self.temp_file.close ()
+        self.memory_file.close ()
+        self.cpu_file.close ()
+
+################################################################################
+# class MetricRing
+################################################################################
+
+class MetricRing :
+    # Fixed size integer ring buffer, memory does not grow with the report
+    # interval. summary () covers the readings still in the ring.
+
+    def __init__ (self, size : int = RING_SIZE) :
+        self.size = size
+        self.values = array ("l", bytes (size * array ("l").itemsize))
+        self.count = 0
+
+    def add (self, value : int) :
+        self.values [self.count % self.size] = value
+        self.count += 1
+
+    def clear (self) :
+        self.count = 0
+
+    def summary (self) -> dict :
+        count = min (self.count, self.size)
+        if count == 0 :
+            return {}
+        values = sorted (self.values [:count])
+        mean = math.fsum (values) / count
+        variance = math.fsum ([(value - mean) ** 2 for value in values]) / count
+        return {
+            "min" : values [0] ,
+            "max" : values [-1] ,
+            "avg" : round (mean, 1) ,
+            "p50" : values [(count - 1) // 2] ,
+            "p95" : values [max (math.ceil (count * 0.95) - 1, 0)] ,
+            "stddev" : round (math.sqrt (variance), 2) ,
+            "count" : count
+            }
+
+################################################################################
+# class IntervalScheduler
+################################################################################
+
+class IntervalScheduler :
+    # Deadlines are start + n * interval on the monotonic clock, so time
+    # spent sampling does not shift later samples. Deadlines that have
+    # already passed by a full interval are skipped and counted in missed.
+
+    def __init__ (self, interval : float, start_time : float = None) :
+        self.interval = interval
+        if start_time is None :
+            start_time = time.monotonic ()
+        self.start_time = start_time
+        self.tick = 0
+        self.missed = 0
+
+    # sleeps until the next deadline, returns its tick number
+    def wait (self) -> int :
+        now = time.monotonic ()
+        next_time = self.start_time + self.tick * self.interval
+        if now < next_time :
+            time.sleep (next_time - now)
+        else :
+            late_intervals = int ((now - next_time) // self.interval)
+            if late_intervals > 0 :
+                self.missed += late_intervals
+                self.tick += late_intervals
+        tick = self.tick
+        self.tick += 1
+        return tick
+
+def publish_worker () :
+    # sends reports so a slow broker does not delay sampling
+    while True :
+        payload = report_queue.get ()
+        if payload is None :
+            break
+        try :
+            mqtt_publisher.publish (TOPIC, payload)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+
+def add_ring_stats () :
+    global mqtt_payload
+    for metric, field_prefix in RING_METRICS.items () :
+        for stat, value in metric_rings [metric].summary ().items () :
+            mqtt_payload [field_prefix + "_" + stat] = value
 
 def get_stats () -> dict :
-    stats = {}
-    data = None
-    with open(CPU_TEMP_PATH, "r") as f:
-        data = f.read()
-    stats ["cpu_temp"] = int(data) // 1000
-    get_memory_stats (stats)
-    #print ("stats:", stats)
-    return stats
+    global stats_sampler
+    if stats_sampler is None :
+        stats_sampler = StatsSampler ()
+    # copy, the sampler updates its dict in place
+    return dict (stats_sampler.sample ())
 
 def get_cpu_times():
-    with open('/proc/stat', 'r') as f:
-        line = f.readline()
-    parts = line.split()
-    # user, nice, system, idle, iowait, irq, softirq, steal, guest, guest_nice
-    cpu_times = [int(x) for x in parts[1:]]
-    return sum(cpu_times), cpu_times[3] # total_time, idle_time
+    return stats_sampler.get_cpu_times ()
 
 def add_disk_stats () :
     global mqtt_payload
     global DISK_TOTAL
     global DISK_WARN_LEVEL
     global DISK_ALERT_LEVEL
-    disk_info = psutil.disk_usage("/")
+    disk_info = stats_sampler.get_disk_usage ()
     if DISK_TOTAL is None :
         DISK_TOTAL =  disk_info.total // (1024**3)
         DISK_WARN_LEVEL = int (DISK_TOTAL * 0.70)
@@ -131,8 +434,21 @@ def add_disk_stats () :
 def init_stats (stats) :
     global mqtt_payload
     global mqtt_payload_aux
+    global metric_rings
     global HOSTNAME
     global MEMORY_AVAIL_WARN
+    # the first call (from main) seeds the rings with the start reading,
+    # after a report they start empty, update_reading already added the
+    # report tick reading to the reported window
+    readings = 0
+    if metric_rings is None :
+        metric_rings = {metric : MetricRing () for metric in RING_METRICS}
+        metric_rings ["cpu_temp"].add (stats ["cpu_temp"])
+        metric_rings ["mem_used"].add (stats ["mem_used"])
+        readings = 1
+    else :
+        for ring in metric_rings.values () :
+            ring.clear ()
     mqtt_payload = {
         "hostname" : HOSTNAME ,
         "datetime" : None ,
@@ -155,15 +471,13 @@ def init_stats (stats) :
         "disk_used" : 0 ,
         "disk_used_warn" : DISK_WARN_LEVEL ,
         "disk_used_alert" : DISK_ALERT_LEVEL ,
-        "readings" : 1
+        "readings" : readings
         }
     mqtt_payload_aux = {
-        "cpu_temp_tot" : stats["cpu_temp"] ,
         "cpu_total_time" : [0, 0] ,
         "cpu_idle_time" : [0, 0] ,
         "cpu_curr_total_time" : 0 ,
-        "cpu_curr_idle_time" : 0 ,
-        "mem_avail_tot" : stats ["mem_avail"]
+        "cpu_curr_idle_time" : 0
         }
     mqtt_payload_aux ["cpu_total_time"][0], mqtt_payload_aux ["cpu_idle_time"][0] \
         = get_cpu_times ()
@@ -175,9 +489,7 @@ def init_stats (stats) :
 def report_stats (stats) :
     global mqtt_payload
     mqtt_payload ["datetime"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    if mqtt_payload ["readings"] > 1 :
-        mqtt_payload ["cpu_temp_avg"] = mqtt_payload_aux ["cpu_temp_tot"] \
-                                        // mqtt_payload ["readings"]
+    add_ring_stats ()
     mqtt_payload_aux ["cpu_total_time"][1], mqtt_payload_aux ["cpu_idle_time"][1] \
         = get_cpu_times ()
     if mqtt_payload_aux ["cpu_total_time"][1] \
@@ -190,6 +502,8 @@ def report_stats (stats) :
     #print ("aux:",mqtt_payload_aux)
     #print ("Sending:", mqtt_payload)
     add_disk_stats ()
+    mqtt_payload ["missed_deadlines"] = sample_scheduler.missed
+    sample_scheduler.missed = 0
     try:
         if True :
             print ("report_stats")
@@ -197,28 +511,21 @@ def report_stats (stats) :
             print ("topic", TOPIC)
             print ("username/password", HA_USERNAME, HA_PASSWORD)
             print ("payload", mqtt_payload)
-        payload = json.dumps (mqtt_payload)
-        # Publish a single message
-        ret = publish.single (TOPIC ,
-                        payload = payload ,
-                        qos = 1 ,
-                        hostname = BROKER_ADDRESS ,
-                        port = BROKER_PORT ,
-                        auth = {'username' : HA_USERNAME ,
-                                'password' : HA_PASSWORD})
-        #print ("rep_stats: ret:", ret)
+        report_queue.put_nowait (dict (mqtt_payload))
+        if mqtt_publisher.dropped > 0 :
+            print ("mqtt messages dropped:", mqtt_publisher.dropped)
+    except queue.Full :
+        print ("report queue full, report dropped")
     except Exception as e:
         print(f"An error occurred: {e}")
     init_stats (stats)
 
 def update_reading (stats) :
     global mqtt_payload
+    # only new readings go into the rings, see SAMPLE_INTERVALS
     # CPU temperature
-    if stats["cpu_temp"] > mqtt_payload ["cpu_temp_max"] :
-        mqtt_payload ["cpu_temp_max"] = stats["cpu_temp"]
-    elif stats["cpu_temp"] < mqtt_payload ["cpu_temp_min"] :
-        mqtt_payload ["cpu_temp_min"] = stats["cpu_temp"]
-    mqtt_payload_aux ["cpu_temp_tot"] += stats["cpu_temp"]
+    if "cpu_temp" in stats_sampler.sampled :
+        metric_rings ["cpu_temp"].add (stats["cpu_temp"])
 
     # CPU Load
     cpu_total_time, cpu_idle_time = get_cpu_times ()
@@ -226,22 +533,13 @@ def update_reading (stats) :
     if cpu_total > 0 :
         cpu_idle = cpu_idle_time - mqtt_payload_aux ["cpu_curr_idle_time"]
         cpu_load  = (((cpu_total - cpu_idle) * 100) // cpu_total)
-        if mqtt_payload ["cpu_load_min"] is None :
-            mqtt_payload ["cpu_load_min"] = cpu_load
-            mqtt_payload ["cpu_load_max"] = cpu_load
-        elif cpu_load < mqtt_payload ["cpu_load_min"] :
-            mqtt_payload ["cpu_load_min"] = cpu_load
-        elif cpu_load > mqtt_payload ["cpu_load_max"] :
-            mqtt_payload ["cpu_load_max"] = cpu_load
+        metric_rings ["cpu_load"].add (cpu_load)
         mqtt_payload_aux ["cpu_curr_total_time"] = cpu_total_time
         mqtt_payload_aux ["cpu_curr_idle_time"] = cpu_idle_time
 
     # Memory
-    if stats["mem_used"] > mqtt_payload ["mem_used_max"] :
-        mqtt_payload ["mem_used_max"] = stats["mem_used"]
-    elif stats["mem_used"] < mqtt_payload ["mem_used_min"] :
-        mqtt_payload ["mem_used_min"] = stats["mem_used"]
-    mqtt_payload_aux ["mem_avail_tot"] += stats["mem_avail"]
+    if "memory" in stats_sampler.sampled :
+        metric_rings ["mem_used"].add (stats["mem_used"])
     mqtt_payload ["swap_tot"] = stats ["swap_tot"]
     mqtt_payload ["swap_used"] = stats ["swap_used"]
     # Other
@@ -283,19 +581,42 @@ def get_ip () :
 
 def main():
     global mqtt_payload
-    global next_report_time
+    global mqtt_publisher
+    global sample_scheduler
+    global report_queue
     print (get_ip())
+    mqtt_publisher = MqttPublisher (HOSTID ,
+                                    BROKER_ADDRESS ,
+                                    BROKER_PORT ,
+                                    HA_USERNAME ,
+                                    HA_PASSWORD)
+    mqtt_publisher.start ()
+    report_queue = queue.Queue (maxsize = REPORT_QUEUE_LIMIT)
+    publish_thread = threading.Thread (target = publish_worker ,
+                                       name = "publish" ,
+                                       daemon = True)
+    publish_thread.start ()
     stats = get_stats ()
     init (stats)
     init_stats (stats)
-    next_report_time = time.time () + REPORT_INTERVAL
-    while True :
-        stats = get_stats ()
-        update_reading (stats)
-        if time.time () >= next_report_time :
-            report_stats (stats)
-            next_report_time = time.time () + REPORT_INTERVAL
-        time.sleep (2)
+    sample_scheduler = IntervalScheduler (CAPTURE_INTERVAL)
+    sample_scheduler.tick = 1       # tick 0 was the init sample above
+    report_ticks = max (round (REPORT_INTERVAL / CAPTURE_INTERVAL), 1)
+    next_report_tick = report_ticks
+    try :
+        while True :
+            sample_tick = sample_scheduler.wait ()
+            stats = get_stats ()
+            update_reading (stats)
+            if sample_tick >= next_report_tick :
+                report_stats (stats)
+                while next_report_tick <= sample_tick :
+                    next_report_tick += report_ticks
+    finally :
+        report_queue.put (None)
+        publish_thread.join ()
+        mqtt_publisher.stop ()
+        stats_sampler.close ()
         
 if __name__ == "__main__":
     main()
@@ -24,11 +24,19 @@
 # THE SOFTWARE.
 ################################################################################
 #
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import io
+import hashlib
 import json
+import os
 import yaml
 import re
+import select
+import struct
+import sys
+import threading
+import time
 #import pprint       # For testing
 
 PACKAGE_HEADERS = \
@@ -50,6 +58,12 @@ template:
 
 TMPL_VAR_RE = r"\{\{\w+\}\}"    # a-z A-z 0-9 _
 
+# Rendered in place of the timestamp, replaced just before output so
+# incremental generate () can hash the text without the timestamp
+TIMESTAMP_MARK = "\x00timestamp\x00"
+MANIFEST_FILE_SUFFIX = "_manifest.json"
+SENSOR_CACHE_VERSION = 3        # change when the cached catalog format changes
+
 
 MQTT_SENSOR_BASIC = \
 '''
@@ -60,6 +74,581 @@ MQTT_SENSOR_BASIC = \
   value_template: "{{ value_json.{{ENTITY}} }}"
 '''
 
+################################################################################
+# class CompiledTemplate
+################################################################################
+
+class CompiledTemplate :
+    # Template text split once into literal text and {{var}} tokens:
+    #   literals [0] token [0] literals [1] token [1] ... literals [-1]
+    # Indented literal lists are built on first use and kept per indent.
+
+    def __init__ (self ,
+                  template_text : str ,
+                  template_pattern = TMPL_VAR_RE) :
+        self.text = template_text
+        self.literals = []
+        self.tokens = []            # (original text, variable name)
+        last_idx = 0
+        for match in re.finditer (template_pattern, template_text) :
+            self.literals.append (template_text [last_idx:match.start ()])
+            token = match.group (0)
+            self.tokens.append ((token, token[2:][:-2]))    # strip '{{' and '}}'
+            last_idx = match.end ()
+        self.literals.append (template_text [last_idx:])
+        self.indented_literals = {"" : self.literals}
+
+    def get_literals (self, indent : str) -> list :
+        literals = self.indented_literals.get (indent)
+        if literals is not None :
+            return literals
+        # Indent every line, same as rendering line by line
+        literals = [literal.replace ("\n", "\n" + indent) for literal in self.literals]
+        if len (self.text) > 0 :
+            literals [0] = indent + literals [0]
+            if self.text [-1] == "\n" :
+                literals [-1] = literals [-1][:-len (indent)]
+        self.indented_literals [indent] = literals
+        return literals
+
+    def render (self ,
+                template_vars : dict = None ,
+                indent : str = "") -> str :
+        literals = self.get_literals (indent)
+        if len (self.tokens) <= 0 :
+            return literals [0]
+        if template_vars is None :
+            template_vars = {}
+        parts = [literals [0]]
+        for token_idx, (token, var_name) in enumerate (self.tokens) :
+            parts.append (template_vars.get (var_name, token))
+            parts.append (literals [token_idx + 1])
+        return "".join (parts)
+
+    def count_unresolved (self, template_vars : dict = None) -> int :
+        if template_vars is None :
+            return len (self.tokens)
+        return sum (1 for _, var_name in self.tokens if var_name not in template_vars)
+
+################################################################################
+# class TemplateRegistry
+################################################################################
+
+class TemplateRegistry :
+    # Process wide template file cache shared by all HaYamlGen objects.
+    # A file is read and compiled on first use and again only when its
+    # mtime or size changes.
+
+    def __init__ (self) :
+        self.templates = {}         # (path, pattern) : (mtime, size, CompiledTemplate)
+        self.lock = threading.Lock ()
+
+    def get (self ,
+             template_file_name : str ,
+             template_pattern = TMPL_VAR_RE) -> CompiledTemplate :
+        file_stat = os.stat (template_file_name)
+        template_key = (template_file_name, template_pattern)
+        template_entry = self.templates.get (template_key)
+        if template_entry is not None \
+        and template_entry [0] == file_stat.st_mtime_ns \
+        and template_entry [1] == file_stat.st_size :
+            return template_entry [2]
+        with open (template_file_name, "r") as t_file :
+            compiled = CompiledTemplate (t_file.read (), template_pattern)
+        with self.lock :
+            self.templates [template_key] = (file_stat.st_mtime_ns ,
+                                             file_stat.st_size ,
+                                             compiled)
+        return compiled
+
+    def clear (self) :
+        with self.lock :
+            self.templates = {}
+
+template_registry = TemplateRegistry ()
+
+################################################################################
+# class GenStats
+################################################################################
+
+class GenStats :
+    # Optional HaYamlGen instrumentation, HaYamlGen (stats = GenStats ())
+    #   timers : stage : {"calls" : n, "seconds" : s}
+    #   counters : name : count
+    #   packages : package id : {"seconds", "bytes", "files", "skipped"}
+    # callback (stage, name, seconds) is called for every timed stage,
+    # with generate (workers) only "package" stages reach the callback, the
+    # other worker timings are merged into timers
+    # Nothing is recorded (and nothing costs) when HaYamlGen.stats is None
+
+    def __init__ (self, callback = None) :
+        self.timers = {}
+        self.counters = {}
+        self.packages = {}
+        self.callback = callback
+
+    def __getstate__ (self) :
+        # callbacks stay in the parent process, see generate (workers)
+        state = dict (self.__dict__)
+        state ["callback"] = None
+        return state
+
+    def add_time (self ,
+                  stage : str ,
+                  seconds : float ,
+                  name : str = None) :
+        timer = self.timers.get (stage)
+        if timer is None :
+            timer = {"calls" : 0, "seconds" : 0.0}
+            self.timers [stage] = timer
+        timer ["calls"] += 1
+        timer ["seconds"] += seconds
+        if self.callback is not None :
+            self.callback (stage, name, seconds)
+
+    def count (self ,
+               name : str ,
+               count : int = 1) :
+        self.counters [name] = self.counters.get (name, 0) + count
+
+    def add_package (self ,
+                     package_id : str ,
+                     seconds : float ,
+                     bytes_written : int ,
+                     files : int ,
+                     skipped : int) :
+        self.packages [package_id] = {
+            "seconds" : seconds ,
+            "bytes" : bytes_written ,
+            "files" : files ,
+            "skipped" : skipped
+            }
+        self.count ("bytes_written", bytes_written)
+        self.add_time ("package", seconds, package_id)
+
+    # add stats recorded in a worker process
+    def merge (self, stats_dict : dict) :
+        for _, (stage, timer) in enumerate (stats_dict ["timers"].items ()) :
+            if stage not in self.timers :
+                self.timers [stage] = {"calls" : 0, "seconds" : 0.0}
+            self.timers [stage]["calls"] += timer ["calls"]
+            self.timers [stage]["seconds"] += timer ["seconds"]
+        for _, (name, count) in enumerate (stats_dict ["counters"].items ()) :
+            self.count (name, count)
+        self.packages.update (stats_dict ["packages"])
+        if self.callback is not None :
+            for _, (package_id, package_stats) in enumerate (stats_dict ["packages"].items ()) :
+                self.callback ("package", package_id, package_stats ["seconds"])
+
+    def to_dict (self) -> dict :
+        return {
+            "timers" : self.timers ,
+            "counters" : self.counters ,
+            "packages" : self.packages
+            }
+
+    def to_json (self) -> str :
+        return json.dumps (self.to_dict (), indent = 1)
+
+    def save_json (self, file_name : str) :
+        with open (file_name, "w") as stats_file :
+            stats_file.write (self.to_json ())
+
+################################################################################
+# class TemplateVariables
+################################################################################
+
+class TemplateVariables :
+    # Template variables for one package, read like a dictionary.
+    # var_table is shared by all packages:
+    #   var name : (None, value)            same for every package
+    #   var name : (format text, sensor)    format text uses {package},
+    #                                       {sensor} and {timestamp}
+    # Package values are formatted the first time a template uses them.
+
+    def __init__ (self ,
+                  var_table : dict ,
+                  package_id : str ,
+                  timestamp : str) :
+        self.var_table = var_table
+        self.package_id = package_id
+        self.timestamp = timestamp
+        self.values = {}
+
+    def get (self, var_name : str, default = None) :
+        value = self.values.get (var_name)
+        if value is not None :
+            return value
+        var_entry = self.var_table.get (var_name)
+        if var_entry is None :
+            return default
+        format_text, value = var_entry
+        if format_text is not None :
+            value = format_text.format (package = self.package_id ,
+                                        sensor = value ,
+                                        timestamp = self.timestamp)
+        self.values [var_name] = value
+        return value
+
+    def __getitem__ (self, var_name : str) :
+        value = self.get (var_name)
+        if value is None :
+            raise KeyError (var_name)
+        return value
+
+    def __contains__ (self, var_name : str) -> bool :
+        return var_name in self.var_table
+
+    def __len__ (self) -> int :
+        return len (self.var_table)
+
+    def __iter__ (self) :
+        return iter (self.var_table)
+
+    def keys (self) :
+        return self.var_table.keys ()
+
+    def items (self) :
+        for var_name in self.var_table :
+            yield var_name, self.get (var_name)
+
+################################################################################
+# class PackageContext
+################################################################################
+
+class PackageContext :
+    # Render state for one package, passed through the generation pipeline
+    # so the generator itself is not changed while rendering
+
+    def __init__ (self ,
+                  package_id : str ,
+                  suffix : str ,
+                  timestamp : str ,
+                  package_indent : str = "  ") :
+        self.package_id = package_id
+        self.timestamp = timestamp
+        self.package_data = {
+            "package" : package_id ,
+            "suffix" : suffix ,
+            "timestamp" : TIMESTAMP_MARK
+            }
+        self.package_indent = package_indent
+        self.template_variables = {}
+        self.templates = {}         # template file : CompiledTemplate for this run
+
+################################################################################
+# class SensorFilter
+################################################################################
+
+class SensorFilter :
+    # Set of json sensor paths and patterns:
+    #   "uid"               key "uid" at any depth
+    #   "readings.voltage"  full json path
+    #   "readings.*_raw"    glob, "*" and "?" match within one path element
+    #   "**.uid"            "**" matches any number of path elements
+    #   "re:<regex>"        regular expression matched against the full path
+    # Names and paths are set lookups, globs are compiled into one regex.
+    # "re:" patterns are compiled when added (re.error is raised there) and
+    # kept separate so their group numbers and backreferences stay valid.
+
+    def __init__ (self) :
+        self.names = set ()
+        self.paths = set ()
+        self.patterns = {}          # glob text : regex
+        self.regex_patterns = {}    # "re:" text : compiled regex
+        self.matcher = None         # compiled on first match after add
+
+    def __len__ (self) -> int :
+        return len (self.names) + len (self.paths) + len (self.patterns) \
+                + len (self.regex_patterns)
+
+    def to_list (self) -> list :
+        return list (self.names) + list (self.paths) + list (self.patterns) \
+                + list (self.regex_patterns)
+
+    def add (self, sensor_path : str) -> bool :
+        # returns False if already in the filter
+        if sensor_path.startswith ("re:") :
+            if sensor_path in self.regex_patterns :
+                return False
+            self.regex_patterns [sensor_path] = re.compile (sensor_path [3:])
+        elif "*" in sensor_path \
+        or "?" in sensor_path :
+            if sensor_path in self.patterns :
+                return False
+            self.patterns [sensor_path] = self.glob_to_regex (sensor_path)
+        elif "." in sensor_path :
+            if sensor_path in self.paths :
+                return False
+            self.paths.add (sensor_path)
+        else :
+            if sensor_path in self.names :
+                return False
+            self.names.add (sensor_path)
+        self.matcher = None
+        return True
+
+    def glob_to_regex (self, pattern : str) -> str :
+        elements = pattern.split (".")
+        last_idx = len (elements) - 1
+        regex_parts = []
+        for element_idx, element in enumerate (elements) :
+            if element == "**" :
+                if element_idx < last_idx :
+                    regex_parts.append (r"(?:[^.]+\.)*")
+                else :
+                    regex_parts.append (r"[^.]+(?:\.[^.]+)*")
+                continue
+            element_regex = re.escape (element).replace (r"\*", "[^.]*").replace (r"\?", "[^.]")
+            if element_idx < last_idx :
+                element_regex += r"\."
+            regex_parts.append (element_regex)
+        return "".join (regex_parts)
+
+    def matches (self ,
+                 sensor_path : str ,
+                 sensor_name : str = None) -> bool :
+        if sensor_name is None :
+            sensor_name = sensor_path.rpartition (".")[2]
+        if sensor_name in self.names \
+        or sensor_path in self.paths :
+            return True
+        for regex in self.regex_patterns.values () :
+            if regex.fullmatch (sensor_path) is not None :
+                return True
+        if len (self.patterns) <= 0 :
+            return False
+        if self.matcher is None :
+            self.matcher = re.compile ("|".join ("(?:" + regex + ")"
+                                                 for regex in self.patterns.values ()))
+        return self.matcher.fullmatch (sensor_path) is not None
+
+################################################################################
+# class SensorSchema
+################################################################################
+
+class SensorSchema :
+    # Sensor types merged from many json samples, memory depends on the
+    # number of json paths, not the number of samples.
+    #   paths : json path : {"types" : {type : count}, "present" : count,
+    #                        "min" : number, "max" : number}
+    # types: "null", "bool", "int", "float", "number_text" (numeric string),
+    #        "str", "list", "object"
+
+    def __init__ (self ,
+                  max_depth : int = None ,
+                  max_paths : int = None) :
+        self.samples = 0
+        self.paths = {}             # first seen order
+        self.max_depth = max_depth  # objects nested deeper are not walked
+        self.max_paths = max_paths  # new paths past this are not recorded
+
+    def add_sample (self, payload : dict) :
+        self.samples += 1
+        # explicit stack, path tuples are joined once per value
+        stack = [((), iter (payload.items ()))]
+        while len (stack) > 0 :
+            object_path, object_items = stack [-1]
+            s_item = next (object_items, None)
+            if s_item is None :
+                stack.pop ()
+                continue
+            s_id, s_data = s_item
+            sensor_path = ".".join (object_path + (s_id,))
+            path_data = self.paths.get (sensor_path)
+            if path_data is None :
+                if self.max_paths is not None \
+                and len (self.paths) >= self.max_paths :
+                    continue
+                path_data = {"types" : {}, "present" : 0, "min" : None, "max" : None}
+                self.paths [sensor_path] = path_data
+            path_data ["present"] += 1
+            value_type = self.get_value_type (s_data)
+            path_data ["types"][value_type] = path_data ["types"].get (value_type, 0) + 1
+            if value_type in ("int", "float") :
+                if path_data ["min"] is None \
+                or s_data < path_data ["min"] :
+                    path_data ["min"] = s_data
+                if path_data ["max"] is None \
+                or s_data > path_data ["max"] :
+                    path_data ["max"] = s_data
+            elif value_type == "object" :
+                if self.max_depth is None \
+                or len (stack) < self.max_depth :
+                    stack.append ((object_path + (s_id,), iter (s_data.items ())))
+
+    def get_value_type (self, value) -> str :
+        if value is None :
+            return "null"
+        if isinstance (value, bool) :
+            return "bool"
+        if isinstance (value, int) :
+            return "int"
+        if isinstance (value, float) :
+            return "float"
+        if isinstance (value, str) :
+            try :
+                float (value)
+                return "number_text"
+            except ValueError :
+                return "str"
+        if isinstance (value, list) :
+            return "list"
+        if isinstance (value, dict) :
+            return "object"
+        return "null"
+
+    # merge a schema built from other samples
+    def merge (self, other) :
+        self.samples += other.samples
+        for _, (sensor_path, other_data) in enumerate (other.paths.items ()) :
+            path_data = self.paths.get (sensor_path)
+            if path_data is None :
+                self.paths [sensor_path] = {
+                    "types" : dict (other_data ["types"]) ,
+                    "present" : other_data ["present"] ,
+                    "min" : other_data ["min"] ,
+                    "max" : other_data ["max"]
+                    }
+                continue
+            path_data ["present"] += other_data ["present"]
+            for _, (value_type, count) in enumerate (other_data ["types"].items ()) :
+                path_data ["types"][value_type] = path_data ["types"].get (value_type, 0) + count
+            for key, better in (("min", min), ("max", max)) :
+                if other_data [key] is None :
+                    continue
+                if path_data [key] is None :
+                    path_data [key] = other_data [key]
+                else :
+                    path_data [key] = better (path_data [key], other_data [key])
+
+    # sensor type after widening all observed types:
+    #   None (object or only null), "numeric", "bool", "str", "list"
+    # A numeric field with some non numeric text ("n/a") stays numeric when
+    # most of its values are numbers
+    def get_sensor_type (self, sensor_path : str) -> str :
+        types = self.paths [sensor_path]["types"]
+        object_count = types.get ("object", 0)
+        list_count = types.get ("list", 0)
+        numeric_count = types.get ("int", 0) + types.get ("float", 0) \
+                        + types.get ("number_text", 0)
+        text_count = types.get ("str", 0)
+        bool_count = types.get ("bool", 0)
+        leaf_count = list_count + numeric_count + text_count + bool_count
+        if leaf_count <= 0 \
+        or object_count >= leaf_count :
+            return None
+        if list_count > 0 :
+            return "list"
+        if numeric_count > 0 \
+        and numeric_count >= text_count :
+            return "numeric"
+        if text_count > 0 :
+            return "str"
+        return "bool"
+
+    def get_presence (self, sensor_path : str) -> float :
+        if self.samples <= 0 :
+            return 0.0
+        return self.paths [sensor_path]["present"] / self.samples
+
+    def to_dict (self) -> dict :
+        return {
+            "samples" : self.samples ,
+            "paths" : self.paths
+            }
+
+################################################################################
+# Output classes, where generate () puts the rendered files
+#   write (file_name, file_text)
+#   read (file_name) -> file_text or None
+#   exists (file_name) -> bool
+#   remove (file_name)
+#   process_safe : True if worker processes can write to it directly
+################################################################################
+
+class FileOutput :
+    # Files in output_dir, each file is written once to a temp file and
+    # renamed so HA never reads a half written package
+
+    process_safe = True
+
+    def __init__ (self, output_dir : str = ".") :
+        self.output_dir = output_dir
+
+    def get_path (self, file_name : str) -> str :
+        return os.path.join (self.output_dir, file_name)
+
+    def write (self, file_name : str, file_text : str) :
+        file_path = self.get_path (file_name)
+        temp_path = "{}.{}.{}.tmp".format (file_path ,
+                                           os.getpid () ,
+                                           threading.get_ident ())
+        try :
+            with open (temp_path, "w") as out_file :
+                out_file.write (file_text)
+            os.replace (temp_path, file_path)
+        except :
+            if os.path.exists (temp_path) :
+                os.remove (temp_path)
+            raise
+
+    def read (self, file_name : str) -> str :
+        try :
+            with open (self.get_path (file_name), "r") as in_file :
+                return in_file.read ()
+        except OSError :
+            return None
+
+    def exists (self, file_name : str) -> bool :
+        return os.path.exists (self.get_path (file_name))
+
+    def remove (self, file_name : str) :
+        file_path = self.get_path (file_name)
+        if os.path.exists (file_path) :
+            os.remove (file_path)
+
+class MemoryOutput :
+    # Files kept in self.files {file name : file text}
+
+    process_safe = False
+
+    def __init__ (self) :
+        self.files = {}
+
+    def write (self, file_name : str, file_text : str) :
+        self.files [file_name] = file_text
+
+    def read (self, file_name : str) -> str :
+        return self.files.get (file_name)
+
+    def exists (self, file_name : str) -> bool :
+        return file_name in self.files
+
+    def remove (self, file_name : str) :
+        self.files.pop (file_name, None)
+
+class StreamOutput :
+    # All files written to one file like object, each file starts with
+    # a "#### File: <file name>" line
+
+    process_safe = False
+
+    def __init__ (self, stream) :
+        self.stream = stream
+
+    def write (self, file_name : str, file_text : str) :
+        self.stream.write ("#### File: " + file_name + "\n" + file_text)
+
+    def read (self, file_name : str) -> str :
+        return None
+
+    def exists (self, file_name : str) -> bool :
+        return False
+
+    def remove (self, file_name : str) :
+        pass
+
 ################################################################################
 # class HaYamlGen
 ################################################################################
@@ -69,54 +658,142 @@ class HaYamlGen :
     def __init__(self,
                 package = "test_package" ,
                 mqtt_topic_base = "test/" ,
-                template_pattern = TMPL_VAR_RE) :
+                template_pattern = TMPL_VAR_RE ,
+                stats : GenStats = None) :
         self.package = package
+        self.stats = stats              # Optional instrumentation
         self.package_items = []
-        self.package_data = None
-        self.package_indent = ""
+        self.package_indent = ""        # render_template_line () only
         self.mqtt_topic_base = mqtt_topic_base
-        self.template_variables = {}
-        self.sensor_include_list = None
-        self.sensor_exclude_list = []
+        self.sensor_include = None      # SensorFilter, None includes all
+        self.sensor_exclude = SensorFilter ()
         self.template_pattern = template_pattern
+        self.compiled_templates = {}    # template text : CompiledTemplate
         self.yaml_indent = ""
         self.sensor_ids = {}
         self.sensor_id_list = {}
+        self.sensor_names = {}          # json key name : owner json path
+        self.sensor_paths = {}          # json path : sensor id
+        self.skipped_paths = set ()
+        self.sensor_schema = None       # SensorSchema from load_json_sensor_stream
+        self.payload_depth_limit = None # max object nesting, None no limit
+        self.payload_sensor_limit = None    # max sensors, None no limit
+        self.payload_array_mode = None  # None, "expand" or "collapse"
+        self.payload_array_limit = 16   # "expand" elements per list
+        self.sensor_yaml = {}           # sensor id : dumped type_dict (skeleton)
+        self.sensor_basic = None        # parsed MQTT_SENSOR_BASIC
+        self.template_var_table = None  # shared by TemplateVariables
         self.card_templates = None      # Optional
         self.ha_templates = None        # Optional
 
-    def get_unique_id (self, sensor_name) :
-        if sensor_name not in self.sensor_id_list :
-            self.sensor_id_list[sensor_name] = {
-                "count" : 0
-                }
-            return sensor_name          # first time
-        self.sensor_id_list[sensor_name]["count"] += 1
-        # generate unique id
-        new_name = sensor_name + "_" + str (self.sensor_id_list[sensor_name]["count"])
-        self.sensor_id_list[new_name] = {
-                "count" : 0
-                }
+    # sensor id for a json key, tried in order:
+    #   key name            "temperature"
+    #   json path name      "readings_temperature"
+    #   path name + hash    "readings_temperature_3f2a9c1e" (hash of the json path)
+    # Key names are reserved before ids are assigned (reserve_sensor_name),
+    # the shallowest json path owns a key name (same depth: the smallest
+    # path), so the ids of one payload do not depend on key order and a
+    # generated id never takes the name of a real json key.
+    def get_unique_id (self ,
+                       sensor_name : str ,
+                       sensor_path : str = None) :
+        if sensor_path is None :
+            sensor_path = sensor_name
+        new_name = sensor_name
+        if new_name in self.sensor_id_list \
+        or self.sensor_names.get (new_name, sensor_path) != sensor_path :
+            new_name = re.sub (r"\W+", "_", sensor_path)
+        if new_name in self.sensor_id_list \
+        or self.sensor_names.get (new_name, sensor_path) != sensor_path :
+            path_hash = hashlib.sha1 (sensor_path.encode ()).hexdigest ()
+            hash_len = 8
+            base_name = new_name
+            new_name = base_name + "_" + path_hash [:hash_len]
+            while new_name in self.sensor_id_list \
+            or new_name in self.sensor_names :
+                hash_len += 4           # only if a json key is named like this
+                if hash_len > len (path_hash) :
+                    path_hash += hashlib.sha1 (path_hash.encode ()).hexdigest ()
+                new_name = base_name + "_" + path_hash [:hash_len]
+        self.sensor_id_list [new_name] = {
+            "path" : sensor_path
+            }
         return new_name
 
-    def card_pro_sensor_vars (self) :
-        package_id = self.package_data ["package"]
-        self.template_variables = {"_PACKAGE_" : package_id ,
-                                    "_TIMESTAMP_" : self.package_data ["timestamp"]}
-        dest_dict = self.template_variables
+    def reserve_sensor_name (self ,
+                             sensor_name : str ,
+                             sensor_path : str) :
+        owner_path = self.sensor_names.get (sensor_name)
+        if owner_path is None \
+        or (owner_path.count ("."), owner_path) > (sensor_path.count ("."), sensor_path) :
+            self.sensor_names [sensor_name] = sensor_path
+
+    # first pass of load_sensor_ids, reserves the key names it will add
+    def reserve_payload_names (self ,
+                               payload : dict ,
+                               base_path : tuple) :
+        stack = [(base_path, iter (payload.items ()), ())]
+        while len (stack) > 0 :
+            object_path, object_items, name_path = stack [-1]
+            s_item = next (object_items, None)
+            if s_item is None :
+                stack.pop ()
+                continue
+            s_id, s_data = s_item
+            sensor_path = ".".join (object_path + (s_id,))
+            if isinstance (s_data, dict) \
+            or (isinstance (s_data, list) and self.payload_array_mode == "expand") :
+                if not self.sensor_is_included (s_id, sensor_path, False) \
+                or (self.payload_depth_limit is not None \
+                    and len (stack) >= self.payload_depth_limit) :
+                    continue
+                child_name_path = ()
+                if isinstance (s_data, list) \
+                or len (name_path) > 0 :
+                    child_name_path = name_path + (s_id,)
+                if isinstance (s_data, dict) :
+                    child_items = iter (s_data.items ())
+                else :
+                    child_items = ((str (element_idx), element)
+                                   for element_idx, element
+                                   in enumerate (s_data [:self.payload_array_limit]))
+                stack.append ((object_path + (s_id,), child_items, child_name_path))
+                continue
+            if not isinstance (s_data, (int, float, bool, str, list)) :
+                continue
+            if len (name_path) > 0 :
+                continue                # expanded names are built from the path
+            if self.sensor_is_included (s_id, sensor_path) :
+                self.reserve_sensor_name (s_id, sensor_path)
+
+    def card_pro_sensor_vars (self, context : PackageContext) :
+        context.template_variables = TemplateVariables (self.get_template_var_table () ,
+                                                        context.package_id ,
+                                                        context.package_data ["timestamp"])
+        #pprint.pprint(dict (context.template_variables.items ()), width=2)
+
+    # variable table for all packages, built once after the sensors are loaded
+    def get_template_var_table (self) -> dict :
+        if self.template_var_table is not None :
+            return self.template_var_table
+        var_table = {"_PACKAGE_" : ("{package}", None) ,
+                     "_TIMESTAMP_" : ("{timestamp}", None)}
         for _, (sensor_name, sensor_data) in enumerate (self.sensor_ids.items ()) :
-            dest_dict [sensor_name] = sensor_data ["entity"]    # json ref
-            entity = "sensor.{}_{}".format (self.package_data ["package"], sensor_name)
+            var_table [sensor_name] = (None, sensor_data ["entity"])    # json ref
             # HA sensor values
-            dest_dict [sensor_name + "_value"] = "states('{}')".format (entity)
-            dest_dict [sensor_name + "_unique_id"] = package_id + "_" + sensor_name
-            #"UNIQUE_ID" : package_id + "_" + sensor_id ,
+            var_table [sensor_name + "_value"] = ("states('sensor.{package}_{sensor}')" ,
+                                                  sensor_name)
+            var_table [sensor_name + "_unique_id"] = ("{package}_{sensor}", sensor_name)
             # Card Pro values
-            dest_dict [sensor_name + "_ent"] = entity
-            dest_dict [sensor_name + "_state"] = '${{states["{}"].state}}'.format (entity)
-            dest_dict [sensor_name + "_id"] = '${{states["{}"].entity_id}}'.format (entity)
-        #pprint.pprint(self.template_variables, width=2)
+            var_table [sensor_name + "_ent"] = ("sensor.{package}_{sensor}", sensor_name)
+            var_table [sensor_name + "_state"] = ('${{states["sensor.{package}_{sensor}"].state}}' ,
+                                                  sensor_name)
+            var_table [sensor_name + "_id"] = ('${{states["sensor.{package}_{sensor}"].entity_id}}' ,
+                                               sensor_name)
+        self.template_var_table = var_table
+        return var_table
 
+    # sensor ids are json paths or patterns, see SensorFilter
     def exclude_sensor (self,
                         sensor_ids : str | list) :
         # Add sensor id(s) to exclude list
@@ -130,12 +807,8 @@ class HaYamlGen :
             # handle error?
             return exclude_count
         for _, sensor_id in enumerate (sensor_list) :
-            sensor_elements = sensor_id.split (".")
-            sensor_id = sensor_elements [-1]    # only test the last element
-            if sensor_id in self.sensor_exclude_list :
-                continue
-            self.sensor_exclude_list.append (sensor_id)
-            exclude_count += 1
+            if self.sensor_exclude.add (sensor_id) :
+                exclude_count += 1
         return exclude_count
     def include_sensor (self,
                         sensor_ids : str | list) :
@@ -148,23 +821,25 @@ class HaYamlGen :
         else :
             # handle error?
             return
-        if self.sensor_include_list is None :
-            self.sensor_include_list = []
+        if self.sensor_include is None :
+            self.sensor_include = SensorFilter ()
         for _, sensor_id in enumerate (sensor_list) :
-            sensor_elements = sensor_id.split (".")
-            for _, element in enumerate (sensor_elements) :
-                if element in self.sensor_include_list :
-                    continue
-                self.sensor_include_list.append (element)
-        print (self.sensor_include_list)
+            self.sensor_include.add (sensor_id)
 
     def sensor_is_included (self,
-                            sensor_id : str) -> bool :
+                            sensor_id : str ,
+                            sensor_path : str = None ,
+                            leaf : bool = True) -> bool :
         # return true if sensor is to be included
-        if sensor_id in self.sensor_exclude_list :
+        # the include list only applies to leaves, objects are walked
+        # so their included sensors can be found
+        if sensor_path is None :
+            sensor_path = sensor_id
+        if self.sensor_exclude.matches (sensor_path, sensor_id) :
             return False
-        if self.sensor_include_list is not None :
-            if sensor_id not in self.sensor_include_list :
+        if self.sensor_include is not None \
+        and leaf :
+            if not self.sensor_include.matches (sensor_path, sensor_id) :
                 return False
         return True
     def build_sensor_path (self, sensor_id, path) :
@@ -181,8 +856,33 @@ class HaYamlGen :
     def get_yaml (self ,
                   yaml_dict) :
         yaml_text = yaml.dump (yaml_dict, allow_unicode=True, sort_keys=False)
+        if self.stats is not None :
+            self.stats.count ("yaml_dump")
         return yaml_text
 
+    # copy of the parsed MQTT_SENSOR_BASIC, parsed on first use only
+    def get_sensor_basic (self) -> list :
+        if self.sensor_basic is None :
+            self.sensor_basic = self.parse_yaml (MQTT_SENSOR_BASIC)
+        # values are flat strings, copying each dict is enough for
+        # update_sensor_ids to change one sensor without touching the others
+        return [dict (sensor_item) for sensor_item in self.sensor_basic]
+
+    # sensor yaml with unrendered {{var}}'s, the same for every package
+    def get_sensor_yaml (self ,
+                         sensor_id : str) -> str :
+        sensor_yaml = self.sensor_yaml.get (sensor_id)
+        if sensor_yaml is None :
+            sensor_yaml = self.get_yaml (self.sensor_ids [sensor_id]["type_dict"])
+            self.sensor_yaml [sensor_id] = sensor_yaml
+        return sensor_yaml
+    def drop_sensor_yaml (self ,
+                          sensor_id : str) :
+        # sensor parameters changed, skeleton must be dumped again
+        sensor_yaml = self.sensor_yaml.pop (sensor_id, None)
+        if sensor_yaml is not None :
+            self.compiled_templates.pop (sensor_yaml, None)
+
     # add sensor attributes to yaml dictionary
     def update_sensor_ids (self ,
                            sensor_id : str | list,
@@ -201,52 +901,161 @@ class HaYamlGen :
                 continue
             for _, (yaml_id, yaml_value) in enumerate (parameters.items()) :
                 self.sensor_ids [sensor_name]["type_dict"][0][yaml_id] = yaml_value
+            self.drop_sensor_yaml (sensor_name)
+
+    # add one sensor for json path, returns the sensor id
+    # entity : value_json reference, default sensor_path
+    def add_sensor (self ,
+                    s_id : str ,
+                    sensor_path : str ,
+                    parameters : dict = None ,
+                    entity : str = None) -> str :
+        if entity is None :
+            entity = sensor_path
+        s_id = self.get_unique_id (s_id, sensor_path)
+        self.sensor_ids [s_id] = {
+            "entity" : entity ,
+            "type_dict" : self.get_sensor_basic ()
+            }
+        self.sensor_paths [sensor_path] = s_id
+        self.drop_sensor_yaml (s_id)
+        self.template_var_table = None
+        if parameters is not None :
+            self.update_sensor_ids (s_id, parameters)
+        return s_id
 
     # load self.sensor_ids from json payload dictionary
+    # The payload is walked with an explicit stack (no recursion limit),
+    # paths are kept as tuples and joined only when a path is checked or a
+    # sensor is added. payload_depth_limit / payload_sensor_limit stop
+    # pathological payloads.
+    # payload_array_mode for json lists:
+    #   None        one sensor with the whole list
+    #   "expand"    walk the list, path "channels.0.v", sensor "channels_0_v"
+    #               (first payload_array_limit elements only)
+    #   "collapse"  list of objects: one sensor per element field with the
+    #               list of its values, path "channels.*.v", sensor "channels_v"
     def load_sensor_ids (self ,
                         payload : dict ,
                         path : str = "") -> int :
-                        #sensor_count : int = 0) :
         #print ("payload:", payload, path)
+        start_time = None
+        if self.stats is not None :
+            start_time = time.perf_counter ()
         sensor_count = 0
-        for _, (s_id, s_data) in enumerate (payload.items()) :
-            # Set sensor code based on data type
-            sensor_path = self.build_sensor_path (s_id, path)
-            if not self.sensor_is_included (s_id) :
-                print ("Skipping:", sensor_path)
+        base_path = ()
+        if len (path) > 0 :
+            base_path = tuple (path.split ("."))
+        self.reserve_payload_names (payload, base_path)
+        # (json path, items iterator, sensor name path inside lists)
+        stack = [(base_path, iter (payload.items ()), ())]
+        while len (stack) > 0 :
+            object_path, object_items, name_path = stack [-1]
+            s_item = next (object_items, None)
+            if s_item is None :
+                stack.pop ()            # object done
+                continue
+            s_id, s_data = s_item
+            is_object = isinstance (s_data, dict)
+            is_array = isinstance (s_data, list)
+            if not is_object \
+            and not isinstance (s_data, (int, float, bool, str, list)) :
+                continue                # Skip all other types
+            walk_array = is_array and self.payload_array_mode == "expand"
+            # the include list is checked on the family paths
+            collapse_array = is_array and self.payload_array_mode == "collapse"
+            sensor_path = ".".join (object_path + (s_id,))
+            sensor_name = s_id
+            if len (name_path) > 0 :
+                sensor_name = "_".join (name_path + (s_id,))
+            if not self.sensor_is_included (s_id ,
+                                            sensor_path ,
+                                            not (is_object or walk_array or collapse_array)) :
+                self.report_skipped_path (sensor_path)
+                continue
+            # Handle dictionary (and expanded lists)
+            if is_object or walk_array :
+                if self.payload_depth_limit is not None \
+                and len (stack) >= self.payload_depth_limit :
+                    self.report_skipped_path (sensor_path, "depth limit")
+                    continue
+                child_name_path = ()
+                if walk_array \
+                or len (name_path) > 0 :
+                    child_name_path = name_path + (s_id,)
+                if is_object :
+                    child_items = iter (s_data.items ())
+                else :
+                    if len (s_data) > self.payload_array_limit :
+                        self.report_skipped_path (sensor_path ,
+                                                  "only {} of {} elements".format (self.payload_array_limit ,
+                                                                                  len (s_data)))
+                    child_items = ((str (element_idx), element)
+                                   for element_idx, element
+                                   in enumerate (s_data [:self.payload_array_limit]))
+                stack.append ((object_path + (s_id,), child_items, child_name_path))
                 continue
+            if collapse_array :
+                family_count = self.add_array_family (sensor_name, sensor_path, s_data)
+                if family_count is not None :
+                    sensor_count += family_count
+                    continue
+                # not a list of objects, one sensor for the whole list
+                if not self.sensor_is_included (s_id, sensor_path) :
+                    self.report_skipped_path (sensor_path)
+                    continue
+            if sensor_path in self.sensor_paths :
+                continue                # already loaded from another sample
+            if self.payload_sensor_limit is not None \
+            and len (self.sensor_ids) >= self.payload_sensor_limit :
+                self.report_skipped_path (sensor_path, "sensor limit")
+                break
             parameters = None
-            # Handle numbers and booleans
-            if isinstance (s_data, (int, float, bool)) :
-                s_id = self.get_unique_id (s_id)
-                type_dict = self.parse_yaml (MQTT_SENSOR_BASIC)
-                if isinstance (s_data, (int, float)) :
-                    parameters = {
-                        "state_class" : "measurement"
-                        }
-                self.sensor_ids [s_id] = {
-                    "entity" : sensor_path ,
-                    "type_dict" : type_dict
+            # Handle numbers and booleans (bool is an int)
+            if isinstance (s_data, (int, float)) :
+                parameters = {
+                    "state_class" : "measurement"
                     }
-                sensor_count += 1
-            # Handle string and lists
-            elif isinstance (s_data, (str, list)) :
-                s_id = self.get_unique_id (s_id)
-                type_dict = self.parse_yaml (MQTT_SENSOR_BASIC)
-                self.sensor_ids [s_id] = {
-                    "entity" : sensor_path ,
-                    "type_dict" : type_dict
-                    }
-                sensor_count += 1
-            # Handle dictionary
-            elif isinstance (s_data, dict) :
-                sensor_count += self.load_sensor_ids (s_data,
-                                                        sensor_path)
-            # Skip all other types
-            else :
-                pass
-            if parameters is not None :
-                self.update_sensor_ids (s_id, parameters)
+            # Handle string and lists, no state class
+            self.add_sensor (sensor_name, sensor_path, parameters)
+            sensor_count += 1
+        if start_time is not None :
+            self.stats.add_time ("load_sensor_ids", time.perf_counter () - start_time)
+            self.stats.count ("sensors_loaded", sensor_count)
+        return sensor_count
+
+    # "collapse" a list of objects into one sensor per element field, the
+    # sensor value is the list of the field values of every element
+    # returns None if the list is not a list of objects
+    def add_array_family (self ,
+                          sensor_name : str ,
+                          sensor_path : str ,
+                          s_data : list) -> int :
+        if len (s_data) <= 0 :
+            return None
+        field_ids = {}                  # first seen order
+        for _, element in enumerate (s_data) :
+            if not isinstance (element, dict) :
+                return None
+            for _, (field_id, field_data) in enumerate (element.items ()) :
+                if isinstance (field_data, (int, float, bool, str)) :
+                    field_ids [field_id] = None
+        sensor_count = 0
+        for _, field_id in enumerate (field_ids) :
+            family_path = sensor_path + ".*." + field_id
+            if family_path in self.sensor_paths :
+                continue
+            if not self.sensor_is_included (field_id, family_path) :
+                self.report_skipped_path (family_path)
+                continue
+            if self.payload_sensor_limit is not None \
+            and len (self.sensor_ids) >= self.payload_sensor_limit :
+                self.report_skipped_path (family_path, "sensor limit")
+                break
+            self.add_sensor (sensor_name + "_" + field_id ,
+                             family_path ,
+                             entity = sensor_path + ' | map(attribute="' + field_id + '") | list')
+            sensor_count += 1
         return sensor_count
 
     def load_json_sensor_ids (self, json_text) :
@@ -268,6 +1077,143 @@ class HaYamlGen :
             return None             # json parse error
         return self.load_sensor_ids (json_dict)
 
+    # yields each json object in a file object without reading it all:
+    # newline delimited json, concatenated objects or a top level array
+    # of objects. Text before the first "{" is ignored (documentation).
+    def iter_json_samples (self ,
+                           json_file ,
+                           chunk_size : int = 1 << 20) :
+        decoder = json.JSONDecoder ()
+        buffer = ""
+        buffer_idx = 0
+        end_of_file = False
+        while True :
+            start_idx = buffer.find ("{", buffer_idx)
+            if start_idx < 0 :
+                if end_of_file :
+                    return
+                buffer = json_file.read (chunk_size)     # nothing left to keep
+                buffer_idx = 0
+                end_of_file = len (buffer) <= 0
+                continue
+            try :
+                sample, end_idx = decoder.raw_decode (buffer, start_idx)
+            except json.JSONDecodeError as error :
+                # json strings can not hold a newline, an error with a
+                # newline after it is a bad sample, not a short read
+                line_end = buffer.find ("\n", error.pos)
+                if line_end < 0 \
+                and not end_of_file :
+                    # object not complete, keep it and read more
+                    chunk = json_file.read (chunk_size)
+                    buffer = buffer [start_idx:] + chunk
+                    buffer_idx = 0
+                    end_of_file = len (chunk) <= 0
+                    continue
+                if line_end < 0 :
+                    line_end = len (buffer)
+                print ("JSON parse error:", buffer [start_idx:min (line_end, start_idx + 200)])
+                if self.stats is not None :
+                    self.stats.count ("json_errors")
+                # skip the rest of the bad line
+                buffer_idx = line_end
+                continue
+            buffer_idx = end_idx
+            yield sample
+
+    # load the sensors of every sample in a file, the sensors of all
+    # samples are combined
+    def load_json_sensor_stream (self ,
+                                 json_file) -> int :
+        # json_file : file name or file object
+        if isinstance (json_file, str) :
+            try :
+                with open (json_file, "r") as stream_file :
+                    return self.load_json_sensor_stream (stream_file)
+            except OSError :
+                print ("JSON file error:", json_file)
+                return None
+        if self.sensor_schema is None :
+            self.sensor_schema = SensorSchema (max_depth = self.payload_depth_limit)
+        for sample in self.iter_json_samples (json_file) :
+            self.sensor_schema.add_sample (sample)
+        return self.load_sensor_schema (self.sensor_schema)
+
+    # load sensors for the json paths in a SensorSchema, the sensor type
+    # comes from all the samples (see SensorSchema.get_sensor_type)
+    def load_sensor_schema (self, schema : SensorSchema) -> int :
+        start_time = None
+        if self.stats is not None :
+            start_time = time.perf_counter ()
+        # reserve the same names load_sensor_ids would
+        for _, sensor_path in enumerate (schema.paths) :
+            if schema.get_sensor_type (sensor_path) is None \
+            or not self.schema_path_is_included (sensor_path, False) :
+                continue
+            if self.payload_depth_limit is not None \
+            and sensor_path.count (".") >= self.payload_depth_limit :
+                continue
+            self.reserve_sensor_name (sensor_path.rpartition (".")[2], sensor_path)
+        sensor_count = 0
+        for _, sensor_path in enumerate (schema.paths) :
+            if sensor_path in self.sensor_paths :
+                continue                # already loaded
+            sensor_type = schema.get_sensor_type (sensor_path)
+            if sensor_type is None :
+                continue                # object or always null
+            if not self.schema_path_is_included (sensor_path) :
+                continue
+            if self.payload_depth_limit is not None \
+            and sensor_path.count (".") >= self.payload_depth_limit :
+                self.report_skipped_path (sensor_path, "depth limit")
+                continue
+            if self.payload_sensor_limit is not None \
+            and len (self.sensor_ids) >= self.payload_sensor_limit :
+                self.report_skipped_path (sensor_path, "sensor limit")
+                break
+            parameters = None
+            if sensor_type == "numeric" :
+                parameters = {
+                    "state_class" : "measurement"
+                    }
+            self.add_sensor (sensor_path.rpartition (".")[2] ,
+                             sensor_path ,
+                             parameters)
+            sensor_count += 1
+        if start_time is not None :
+            self.stats.add_time ("load_sensor_schema", time.perf_counter () - start_time)
+            self.stats.count ("sensors_loaded", sensor_count)
+        return sensor_count
+
+    def schema_path_is_included (self ,
+                                 sensor_path : str ,
+                                 report : bool = True) -> bool :
+        # excluded objects exclude every path below them
+        path_elements = sensor_path.split (".")
+        for element_idx in range (1, len (path_elements)) :
+            object_path = ".".join (path_elements [:element_idx])
+            if not self.sensor_is_included (path_elements [element_idx - 1] ,
+                                            object_path ,
+                                            False) :
+                if report :
+                    self.report_skipped_path (object_path)
+                return False
+        if not self.sensor_is_included (path_elements [-1], sensor_path) :
+            if report :
+                self.report_skipped_path (sensor_path)
+            return False
+        return True
+
+    def report_skipped_path (self ,
+                             sensor_path : str ,
+                             reason : str = None) :
+        if sensor_path not in self.skipped_paths :
+            self.skipped_paths.add (sensor_path)
+            if reason is None :
+                print ("Skipping:", sensor_path)
+            else :
+                print ("Skipping:", sensor_path, "(" + reason + ")")
+
     def load_json_sensor_file (self, json_file_name) :
         json_text = None
         try :
@@ -278,138 +1224,439 @@ class HaYamlGen :
             return None
         return self.load_json_sensor_ids (json_text)
 
+    # load_json_sensor_ids + update_sensor_ids (overrides) using a cache file
+    # overrides : {sensor id : update_sensor_ids parameters}
+    # The cache is used if the payload text, overrides, include/exclude and
+    # payload options are the same as when it was written.
+    def load_json_sensor_ids_cached (self ,
+                                     json_text : str ,
+                                     cache_file_name : str ,
+                                     overrides : dict = None) -> int :
+        if overrides is None :
+            overrides = {}
+        cache_key = self.get_sensor_cache_key (json_text, overrides)
+        catalog = None
+        try :
+            with open (cache_file_name, "r") as cache_file :
+                catalog = json.load (cache_file)
+        except :
+            catalog = None          # missing or unreadable, load the payload
+        if catalog is not None \
+        and catalog.get ("version") == SENSOR_CACHE_VERSION \
+        and catalog.get ("key") == cache_key :
+            self.set_sensor_catalog (catalog)
+            return catalog ["sensor_count"]
+        sensor_count = self.load_json_sensor_ids (json_text)
+        if sensor_count is None :
+            return None
+        for _, (sensor_id, parameters) in enumerate (overrides.items ()) :
+            self.update_sensor_ids (sensor_id, parameters)
+        catalog = self.get_sensor_catalog ()
+        catalog ["key"] = cache_key
+        catalog ["sensor_count"] = sensor_count
+        temp_file_name = cache_file_name + "." + str (os.getpid ()) + ".tmp"
+        with open (temp_file_name, "w") as cache_file :
+            json.dump (catalog, cache_file, separators = (",", ":"))
+        os.replace (temp_file_name, cache_file_name)
+        return sensor_count
+
+    def get_sensor_cache_key (self ,
+                              json_text : str ,
+                              overrides : dict) -> str :
+        include_list = None
+        if self.sensor_include is not None :
+            include_list = sorted (self.sensor_include.to_list ())
+        # the cached catalog holds every sensor of the generator, sensors
+        # loaded before this payload are part of the key
+        loaded_hash = None
+        if len (self.sensor_ids) > 0 :
+            loaded_hash = hashlib.sha256 (json.dumps ([self.sensor_ids ,
+                                                       self.sensor_id_list ,
+                                                       self.sensor_names ,
+                                                       self.sensor_paths] ,
+                                                      sort_keys = True ,
+                                                      default = str).encode ()).hexdigest ()
+        key_data = json.dumps ({
+            "version" : SENSOR_CACHE_VERSION ,
+            "loaded" : loaded_hash ,
+            "payload" : json_text ,
+            "overrides" : overrides ,
+            "include" : include_list ,
+            "exclude" : sorted (self.sensor_exclude.to_list ()) ,
+            "depth_limit" : self.payload_depth_limit ,
+            "sensor_limit" : self.payload_sensor_limit ,
+            "array_mode" : self.payload_array_mode ,
+            "array_limit" : self.payload_array_limit
+            }, ensure_ascii = False, default = str)
+        return hashlib.sha256 (key_data.encode ()).hexdigest ()
+
+    # loaded sensors as a json compatible dictionary
+    def get_sensor_catalog (self) -> dict :
+        include_list = None
+        if self.sensor_include is not None :
+            include_list = self.sensor_include.to_list ()
+        return {
+            "version" : SENSOR_CACHE_VERSION ,
+            "sensor_ids" : self.sensor_ids ,
+            "sensor_id_list" : self.sensor_id_list ,
+            "sensor_names" : self.sensor_names ,
+            "sensor_paths" : self.sensor_paths ,
+            "include" : include_list ,
+            "exclude" : self.sensor_exclude.to_list ()
+            }
+
+    def set_sensor_catalog (self, catalog : dict) -> int :
+        self.sensor_ids = catalog ["sensor_ids"]
+        self.sensor_id_list = catalog ["sensor_id_list"]
+        self.sensor_names = catalog ["sensor_names"]
+        self.sensor_paths = catalog ["sensor_paths"]
+        if catalog ["include"] is not None :
+            self.include_sensor (catalog ["include"])
+        self.exclude_sensor (catalog ["exclude"])
+        for _, sensor_id in enumerate (list (self.sensor_yaml)) :
+            self.drop_sensor_yaml (sensor_id)
+        self.template_var_table = None
+        return len (self.sensor_ids)
+
     # generate :
     # mqtt sensor yaml
     # HA template yaml included with sensor yaml (optional)
     # card yaml(s) (optional)
-    def generate (self) :
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # workers > 1 spreads the packages over a process pool, each worker gets
+    # one copy of the generator (sensor catalog and compiled templates)
+    # incremental = True only writes files whose text (without the timestamp)
+    # changed since the last incremental run, see <package>_manifest.json
+    # output : FileOutput, MemoryOutput, StreamOutput, default current directory
+    # returns {"written" : [file names], "skipped" : [...], "removed" : [...]}
+    def generate (self ,
+                  workers : int = None ,
+                  incremental : bool = False ,
+                  output = None) -> dict :
+        if output is None :
+            output = FileOutput ()
+        context_list = self.get_package_contexts ()
+        file_hashes = None
+        if incremental :
+            # files missing from the output are written again
+            file_hashes = {file_name : file_hash
+                           for file_name, file_hash in self.load_manifest (output).items ()
+                           if output.exists (file_name)}
+        results = {}
+        if workers is None \
+        or workers <= 1 \
+        or len (context_list) <= 1 :
+            for _, context in enumerate (context_list) :
+                results.update (self.build_package_files (context ,
+                                                          file_hashes ,
+                                                          output))
+        else :
+            # Every package writes its own files, the output does not depend
+            # on which worker builds it or in what order
+            # Outputs that live in this process get the files sent back
+            worker_output = None
+            if output.process_safe :
+                worker_output = output
+            chunk_size = max (1, len (context_list) // (workers * 4))
+            with ProcessPoolExecutor (max_workers = workers ,
+                                      initializer = init_package_worker ,
+                                      initargs = (self ,
+                                                  file_hashes ,
+                                                  worker_output)) as executor :
+                for package_results, package_files, package_stats \
+                in executor.map (build_worker_package ,
+                                 context_list ,
+                                 chunksize = chunk_size) :
+                    results.update (package_results)
+                    if package_stats is not None :
+                        self.stats.merge (package_stats)
+                    for _, (file_name, file_text) in enumerate (package_files.items ()) :
+                        output.write (file_name, file_text)
+        report = {
+            "written" : [] ,
+            "skipped" : [] ,
+            "removed" : []
+            }
+        for _, (file_name, (_, written)) in enumerate (results.items ()) :
+            if written :
+                report ["written"].append (file_name)
+            else :
+                report ["skipped"].append (file_name)
+        if incremental :
+            # remove files from the last run that are no longer generated
+            for _, file_name in enumerate (file_hashes) :
+                if file_name in results :
+                    continue
+                output.remove (file_name)
+                report ["removed"].append (file_name)
+            self.save_manifest ({file_name : file_hash
+                                for file_name, (file_hash, _) in results.items ()} ,
+                                output)
+        return report
+
+    # one context per package item, all with the same timestamp
+    def get_package_contexts (self, timestamp : str = None) -> list :
+        if timestamp is None :
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        templates = self.get_run_templates ()
+        context_list = []
         for _, package_item in enumerate (self.package_items) :
-            self.package_data = {
-                "package" : self.package + package_item ["suffix"] ,
-                "suffix" : package_item ["suffix"] ,
-                "timestamp" : timestamp
-                }
-            self.build_package_files ()
-
-    def build_package_files (self) :
-        self.package_indent = "  "
-        package_id = self.package_data ["package"]
-        self.card_pro_sensor_vars ()
-        yaml_file_name = package_id + "_pkg.yaml"
-        with open (yaml_file_name, "w") as yaml_file :
-            with io.StringIO (PACKAGE_HEADERS) as t_buff :
-                for t_line in t_buff :
-                    out_line = self.render_template_line (t_line, self.package_data)
-                    yaml_file.write (out_line)
-            self.generate_mqtt_sensors (yaml_file)
-            self.generate_ha_templates (yaml_file)
-        self.generate_cards (package_id)
-
-    def generate_mqtt_sensors (self, yaml_file) :
-        package_id = self.package_data ["package"]
-        with io.StringIO (MQTT_SENSOR_HEADERS) as t_buff :
-            for t_line in t_buff :
-                out_line = self.render_template_line (t_line, self.package_data, "")
-                yaml_file.write (out_line)
+            context_list.append (self.get_package_context (package_item ["suffix"],
+                                                           timestamp ,
+                                                           templates))
+        return context_list
+
+    # templates : from get_run_templates (), None looks them up
+    def get_package_context (self ,
+                             suffix : str ,
+                             timestamp : str = None ,
+                             templates : dict = None) -> PackageContext :
+        if timestamp is None :
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        context = PackageContext (self.package + suffix, suffix, timestamp)
+        if templates is None :
+            templates = self.get_run_templates ()
+        context.templates = templates
+        return context
+
+    # render all packages without writing files
+    # yields (file name, yaml text), one package at a time
+    def iter_render (self, timestamp : str = None) :
+        for _, context in enumerate (self.get_package_contexts (timestamp)) :
+            for _, (file_name, file_text) in enumerate (self.render_context (context).items ()) :
+                yield file_name, file_text
+
+    # returns {file name : yaml text} for all packages
+    def render (self, timestamp : str = None) -> dict :
+        return dict (self.iter_render (timestamp))
+
+    # render one package without writing files or changing the generator
+    # returns {file name : yaml text}
+    def render_package (self ,
+                        suffix : str ,
+                        timestamp : str = None) -> dict :
+        return self.render_context (self.get_package_context (suffix, timestamp))
+
+    def render_context (self, context : PackageContext) -> dict :
+        outputs = self.render_context_body (context)
+        for _, (file_name, file_text) in enumerate (outputs.items ()) :
+            outputs [file_name] = file_text.replace (TIMESTAMP_MARK, context.timestamp)
+        return outputs
+
+    # rendered text with TIMESTAMP_MARK in place of the timestamp
+    def render_context_body (self, context : PackageContext) -> dict :
+        start_time = None
+        if self.stats is not None :
+            start_time = time.perf_counter ()
+        self.card_pro_sensor_vars (context)
+        if start_time is not None :
+            end_time = time.perf_counter ()
+            self.stats.add_time ("sensor_vars", end_time - start_time, context.package_id)
+            start_time = end_time
+        outputs = {}
+        yaml_chunks = [self.render_template (PACKAGE_HEADERS, context.package_data)]
+        self.generate_mqtt_sensors (context, yaml_chunks)
+        if start_time is not None :
+            self.stats.add_time ("mqtt_sensors" ,
+                                 time.perf_counter () - start_time ,
+                                 context.package_id)
+        self.generate_ha_templates (context, yaml_chunks)
+        outputs [context.package_id + "_pkg.yaml"] = "".join (yaml_chunks)
+        outputs.update (self.generate_cards (context))
+        return outputs
+
+    # file_hashes : {file name : hash} from the last run, None writes all files
+    # returns {file name : (hash, written)}
+    def build_package_files (self ,
+                             context : PackageContext ,
+                             file_hashes : dict = None ,
+                             output = None) -> dict :
+        if output is None :
+            output = FileOutput ()
+        start_time = None
+        if self.stats is not None :
+            start_time = time.perf_counter ()
+            bytes_written = 0
+            skipped = 0
+        outputs = self.render_context_body (context)
+        results = {}
+        for _, (file_name, file_text) in enumerate (outputs.items ()) :
+            file_hash = hashlib.sha256 (file_text.encode ()).hexdigest ()
+            if file_hashes is not None \
+            and file_hashes.get (file_name) == file_hash :
+                results [file_name] = (file_hash, False)
+                if start_time is not None :
+                    skipped += 1
+                continue
+            file_text = file_text.replace (TIMESTAMP_MARK, context.timestamp)
+            if start_time is not None :
+                write_start_time = time.perf_counter ()
+            output.write (file_name, file_text)
+            results [file_name] = (file_hash, True)
+            if start_time is not None :
+                self.stats.add_time ("write", time.perf_counter () - write_start_time, file_name)
+                bytes_written += len (file_text.encode ())
+        if start_time is not None :
+            self.stats.add_package (context.package_id ,
+                                    time.perf_counter () - start_time ,
+                                    bytes_written ,
+                                    len (outputs) - skipped ,
+                                    skipped)
+        return results
+
+    def get_manifest_file_name (self) -> str :
+        return self.package + MANIFEST_FILE_SUFFIX
+
+    def load_manifest (self, output) -> dict :
+        try :
+            return json.loads (output.read (self.get_manifest_file_name ())) ["files"]
+        except :
+            return {}           # first run or unreadable, write everything
+
+    def save_manifest (self, file_hashes : dict, output) :
+        output.write (self.get_manifest_file_name () ,
+                      json.dumps ({"files" : file_hashes}, indent = 1))
+
+    def generate_mqtt_sensors (self ,
+                               context : PackageContext ,
+                               yaml_chunks : list) :
+        package_id = context.package_id
+        yaml_chunks.append (self.render_template (MQTT_SENSOR_HEADERS ,
+                                                  context.package_data ,
+                                                  "" ,
+                                                  context.package_indent))
         for _, (sensor_id,_) in enumerate (self.sensor_id_list.items()) :
-            #print (self.package_data ["suffix"])
+            #print (context.package_data ["suffix"])
             sensor_vars = {
                 "NAME" : package_id + " " + sensor_id ,
-                "FRIENDLY_NAME" : self.package_data ["suffix"][1:] + " " + sensor_id ,
-                "ENTITY" : self.template_variables [sensor_id] ,
+                "FRIENDLY_NAME" : context.package_data ["suffix"][1:] + " " + sensor_id ,
+                "ENTITY" : context.template_variables [sensor_id] ,
                 "UNIQUE_ID" : package_id + "_" + sensor_id ,
                 "STATE_TOPIC" : self.mqtt_topic_base + package_id
                 }
-            sensor_dict = self.sensor_ids [sensor_id]["type_dict"]
-            sensor_yaml = self.get_yaml (sensor_dict)
-            yaml_file.write ("\n")
-            with io.StringIO (sensor_yaml) as s_buff :
-                for sensor_line in s_buff :
-                    out_line = self.render_template_line (sensor_line,
-                                                          sensor_vars ,
-                                                          indent = "    ")
-                    yaml_file.write (out_line)
+            sensor_yaml = self.get_sensor_yaml (sensor_id)
+            yaml_chunks.append ("\n")
+            yaml_chunks.append (self.render_template (sensor_yaml,
+                                                      sensor_vars ,
+                                                      indent = "    " ,
+                                                      package_indent = context.package_indent))
 
     # substitute template variable with actual value
 
+    def compile_template (self,
+                          template : str) -> CompiledTemplate :
+        compiled = self.compiled_templates.get (template)
+        if compiled is None :
+            compiled = CompiledTemplate (template, self.template_pattern)
+            self.compiled_templates [template] = compiled
+        return compiled
+
+    def get_template_file (self, template_file_name : str) -> CompiledTemplate :
+        return template_registry.get (template_file_name, self.template_pattern)
+
+    # every template file looked up once, all packages of a run share them
+    def get_run_templates (self) -> dict :
+        templates = {}
+        for _, template_data in enumerate ((self.ha_templates or []) + (self.card_templates or [])) :
+            if template_data ["file"] not in templates :
+                templates [template_data ["file"]] = self.get_template_file (template_data ["file"])
+        return templates
+
+    # template : template text or CompiledTemplate
+    def render_template (self ,
+                         template : str ,
+                         template_vars : dict = None ,
+                         indent : str = None ,
+                         package_indent : str = None) -> str :
+        # Render a whole template text, indent is added to each line
+        full_indent = ""
+        if indent is not None :
+            if package_indent is None :
+                package_indent = self.package_indent
+            full_indent = indent + package_indent
+        if isinstance (template, CompiledTemplate) :
+            compiled = template
+        else :
+            compiled = self.compile_template (template)
+        if self.stats is not None :
+            self.stats.count ("render_template")
+            self.stats.count ("unresolved_vars", compiled.count_unresolved (template_vars))
+        return compiled.render (template_vars, full_indent)
+
     def render_template_line (self ,
                                 template : str ,
                                 template_vars : dict = None ,
                                 indent : str = None) -> str :
-        temp_vars = template_vars            # substitute template variables
-        if temp_vars is None :
-            temp_vars = {}
-        full_indent = ""
-        if indent is not None :
-            full_indent = indent + self.package_indent
-        # Template variable substitution function
-        def handle_template_variable (match) :
-            var_name = match.group(0)[2:][:-2]  # strip leading '{{' and ending '}}'
-            if var_name not in temp_vars :
-                return match.group(0)           # return original text
-            return temp_vars [var_name]     # return substitute value
-        # Return indentation + rendered template line
-        return full_indent + re.sub (self.template_pattern,
-                                    handle_template_variable,
-                                    template)
+        return self.render_template (template, template_vars, indent)
 
+    # template files are read when first rendered, see TemplateRegistry
+    # a missing file raises FileNotFoundError here
     def add_ha_template (self,
                         template_file_name) :
-        template_text = None
-        with open (template_file_name, "r") as t_file :
-            template_text = t_file.read ()
+        template_path = os.path.abspath (template_file_name)
+        os.stat (template_path)
         if self.ha_templates is None :
             self.ha_templates = []
         self.ha_templates.append ({
-            "text" : template_text
+            "file" : template_path
             })
         #pprint.pprint (self.ha_templates)
         
     def generate_ha_templates (self,
-                                yaml_file) -> None :
+                                context : PackageContext ,
+                                yaml_chunks : list) -> None :
         if self.ha_templates is None :
             return
-        with io.StringIO (TEMPLATE_SENSOR_HEADERS) as t_buff :
-            for t_line in t_buff :
-                out_line = self.render_template_line (t_line, self.package_data, "")
-                yaml_file.write (out_line)
+        start_time = None
+        if self.stats is not None :
+            start_time = time.perf_counter ()
+        yaml_chunks.append (self.render_template (TEMPLATE_SENSOR_HEADERS ,
+                                                  context.package_data ,
+                                                  "" ,
+                                                  context.package_indent))
         for ha_idx, ha_data in enumerate (self.ha_templates) :
-            with io.StringIO (ha_data["text"]) as t_buff :
-                for t_line in t_buff :
-                    out_line = self.render_template_line (t_line, self.template_variables, "")
-                    yaml_file.write (out_line)
-            #yaml_file.write ("\n###### End Templates ######\n")
+            yaml_chunks.append (self.render_template (context.templates [ha_data["file"]] ,
+                                                      context.template_variables ,
+                                                      "" ,
+                                                      context.package_indent))
+            #yaml_chunks.append ("\n###### End Templates ######\n")
+        if start_time is not None :
+            self.stats.add_time ("ha_templates" ,
+                                 time.perf_counter () - start_time ,
+                                 context.package_id)
 
     def add_card_template (self,
                            template_file_name,
                            card_suffix = "") :
-        template_text = None
         suffix = card_suffix
         if len (suffix) > 0 :
             if suffix [0:1] != "_" :
                 suffix = "_" + suffix
-        with open (template_file_name, "r") as t_file :
-            template_text = t_file.read ()
+        template_path = os.path.abspath (template_file_name)
+        os.stat (template_path)
         if self.card_templates is None :
             self.card_templates = []
         self.card_templates.append ({
-            "text" : template_text ,
+            "file" : template_path ,
             "suffix" : suffix
             })
         #pprint.pprint (self.card_templates)
         
-    def generate_cards (self, package_id) :
+    # returns {card file name : card yaml text}
+    def generate_cards (self, context : PackageContext) -> dict :
+        cards = {}
         if self.card_templates is None :
-            return
+            return cards
         for card_idx, card_data in enumerate (self.card_templates) :
-            card_file_name = package_id + "_card" + card_data["suffix"] + ".yaml"
+            card_file_name = context.package_id + "_card" + card_data["suffix"] + ".yaml"
             #print (card_file_name)
-            with open (card_file_name, "w") as out_file :
-                with io.StringIO(card_data["text"]) as t_buff :
-                    for card_line in t_buff :
-                        out_line = self.render_template_line (card_line, self.template_variables)
-                        out_file.write (out_line)
+            start_time = None
+            if self.stats is not None :
+                start_time = time.perf_counter ()
+            cards [card_file_name] = self.render_template (context.templates [card_data["file"]] ,
+                                                           context.template_variables)
+            if start_time is not None :
+                self.stats.add_time ("card", time.perf_counter () - start_time, card_file_name)
+        return cards
 
     # Nest 2 functions build a list of suffixes to make multiple sensors yaml unique
     def build_range_list (self, start = 0, count = 1) :
@@ -423,12 +1670,387 @@ class HaYamlGen :
                 "suffix" : "_" + id_item
                 })
 
+################################################################################
+# generate () process pool workers
+################################################################################
+
+worker_gen = None           # HaYamlGen copy, one per worker process
+
+worker_file_hashes = None   # incremental generate () manifest
+worker_output = None        # None: send the files back to generate ()
+
+def init_package_worker (gen, file_hashes, output) :
+    global worker_gen
+    global worker_file_hashes
+    global worker_output
+    worker_gen = gen
+    worker_file_hashes = file_hashes
+    worker_output = output
+
+def build_worker_package (context) :
+    output = worker_output
+    if output is None :
+        output = MemoryOutput ()
+    package_stats = None
+    if worker_gen.stats is not None :
+        worker_gen.stats = GenStats ()      # only this package, merged by generate ()
+    results = worker_gen.build_package_files (context ,
+                                              worker_file_hashes ,
+                                              output)
+    if worker_gen.stats is not None :
+        package_stats = worker_gen.stats.to_dict ()
+    if output is worker_output :
+        return results, {}, package_stats
+    return results, output.files, package_stats
+
+################################################################################
+# Batch config, python -m ha_yaml_gen devices.yaml
+#
+# output_dir: packages          # optional, default current directory
+# workers: 4                    # optional, see generate ()
+# incremental: true             # optional, see generate ()
+# devices:
+#   - package: indoor
+#     mqtt_topic_base: enviro/
+#     payload_file: indoor.json # or payload: <json text>
+#                               # or payload_stream: samples.ndjson
+#     cache: indoor_cache.json  # optional, see load_json_sensor_ids_cached
+#     exclude: [model, uid]     # optional
+#     include: [...]            # optional
+#     array_mode: expand        # optional payload_array_mode
+#     ids: [kitchen, bedroom]   # or range: {start: 0, count: 2}
+#     overrides:                # optional update_sensor_ids
+#       timestamp: {device_class: timestamp}
+#     ha_templates: [indoor.tmpl]
+#     cards: [indoor.card, {file: indoor_phone.card, suffix: phone}]
+#
+# File names are relative to the config file directory.
+################################################################################
+
+def build_device_generator (device : dict ,
+                            base_dir : str) -> HaYamlGen :
+    def config_path (file_name) :
+        return os.path.join (base_dir, file_name)
+    gen = HaYamlGen (package = device ["package"] ,
+                     mqtt_topic_base = device.get ("mqtt_topic_base", "test/"))
+    if "exclude" in device :
+        gen.exclude_sensor (device ["exclude"])
+    if "include" in device :
+        gen.include_sensor (device ["include"])
+    gen.payload_depth_limit = device.get ("depth_limit")
+    gen.payload_sensor_limit = device.get ("sensor_limit")
+    gen.payload_array_mode = device.get ("array_mode")
+    gen.payload_array_limit = device.get ("array_limit", gen.payload_array_limit)
+    overrides = device.get ("overrides") or {}
+    if "payload_stream" in device :
+        sensor_count = gen.load_json_sensor_stream (config_path (device ["payload_stream"]))
+        for _, (sensor_id, parameters) in enumerate (overrides.items ()) :
+            gen.update_sensor_ids (sensor_id, parameters)
+    else :
+        json_text = device.get ("payload")
+        if json_text is None :
+            with open (config_path (device ["payload_file"]), "r") as json_file :
+                json_text = json_file.read ()
+        if "cache" in device :
+            sensor_count = gen.load_json_sensor_ids_cached (json_text ,
+                                                            config_path (device ["cache"]) ,
+                                                            overrides)
+        else :
+            sensor_count = gen.load_json_sensor_ids (json_text)
+            for _, (sensor_id, parameters) in enumerate (overrides.items ()) :
+                gen.update_sensor_ids (sensor_id, parameters)
+    if sensor_count is None :
+        return None
+    if "ids" in device :
+        gen.build_id_list (ids = [str (id_item) for id_item in device ["ids"]])
+    if "range" in device :
+        gen.build_range_list (start = device ["range"].get ("start", 0) ,
+                              count = device ["range"].get ("count", 1))
+    for _, template_file_name in enumerate (device.get ("ha_templates") or []) :
+        gen.add_ha_template (config_path (template_file_name))
+    for _, card in enumerate (device.get ("cards") or []) :
+        if isinstance (card, str) :
+            card = {"file" : card}
+        gen.add_card_template (config_path (card ["file"]), card.get ("suffix", ""))
+    return gen
+
+# returns (config dictionary, config file directory)
+def load_config (config_file_name : str) :
+    with open (config_file_name, "r") as config_file :
+        config = yaml.safe_load (config_file)
+    return config, os.path.dirname (os.path.abspath (config_file_name))
+
+def get_config_output (config : dict ,
+                       base_dir : str ,
+                       output_dir : str = None) -> FileOutput :
+    if output_dir is None :
+        output_dir = config.get ("output_dir", ".")
+        if not os.path.isabs (output_dir) :
+            output_dir = os.path.join (base_dir, output_dir)
+    os.makedirs (output_dir, exist_ok = True)
+    return FileOutput (output_dir)
+
+# input files of a device entry (absolute paths)
+def get_device_inputs (device : dict ,
+                       base_dir : str) -> set :
+    file_names = []
+    for key in ("payload_file", "payload_stream") :
+        if key in device :
+            file_names.append (device [key])
+    file_names += device.get ("ha_templates") or []
+    for _, card in enumerate (device.get ("cards") or []) :
+        if isinstance (card, str) :
+            file_names.append (card)
+        else :
+            file_names.append (card ["file"])
+    return {os.path.abspath (os.path.join (base_dir, file_name)) for file_name in file_names}
+
+def generate_device (device : dict ,
+                     base_dir : str ,
+                     output ,
+                     workers : int = None ,
+                     incremental : bool = False) -> dict :
+    gen = build_device_generator (device, base_dir)
+    if gen is None :
+        print ("Device not generated:", device.get ("package"))
+        return None
+    report = gen.generate (workers = workers ,
+                           incremental = incremental ,
+                           output = output)
+    print ("{}: {} written, {} skipped, {} removed".format (device ["package"] ,
+                                                          len (report ["written"]) ,
+                                                          len (report ["skipped"]) ,
+                                                          len (report ["removed"])))
+    return report
+
+# generate every device in a config file, returns {package : generate () report}
+def run_config (config_file_name : str ,
+                workers : int = None ,
+                incremental : bool = None ,
+                output_dir : str = None) -> dict :
+    config, base_dir = load_config (config_file_name)
+    if workers is None :
+        workers = config.get ("workers")
+    if incremental is None :
+        incremental = config.get ("incremental", False)
+    output = get_config_output (config, base_dir, output_dir)
+    reports = {}
+    for _, device in enumerate (config.get ("devices") or []) :
+        report = generate_device (device, base_dir, output, workers, incremental)
+        if report is not None :
+            reports [device ["package"]] = report
+    return reports
+
+################################################################################
+# Watch mode, python -m ha_yaml_gen devices.yaml --watch
+#
+# Watcher classes:
+#   wait_changes (timeout) -> set of changed watched files (absolute paths)
+################################################################################
+
+class PollingWatcher :
+    # compares file mtime and size every interval seconds
+
+    def __init__ (self ,
+                  file_names ,
+                  interval : float = 0.5) :
+        self.interval = interval
+        self.file_states = {file_name : self.get_file_state (file_name)
+                            for file_name in file_names}
+
+    def get_file_state (self, file_name : str) :
+        try :
+            file_stat = os.stat (file_name)
+            return (file_stat.st_mtime_ns, file_stat.st_size)
+        except OSError :
+            return None
+
+    def wait_changes (self, timeout : float = None) -> set :
+        end_time = None
+        if timeout is not None :
+            end_time = time.monotonic () + timeout
+        while True :
+            changed = set ()
+            for _, (file_name, file_state) in enumerate (self.file_states.items ()) :
+                new_state = self.get_file_state (file_name)
+                if new_state != file_state :
+                    self.file_states [file_name] = new_state
+                    changed.add (file_name)
+            if len (changed) > 0 :
+                return changed
+            if end_time is not None \
+            and time.monotonic () >= end_time :
+                return changed
+            time.sleep (self.interval)
+
+    def close (self) :
+        pass
+
+class InotifyWatcher :
+    # Linux inotify through libc, the directories are watched so files
+    # replaced by an editor (write temp file and rename) are seen
+
+    EVENT_MASK = 0x2 | 0x8 | 0x80 | 0x100 | 0x200  # MODIFY CLOSE_WRITE MOVED_TO CREATE DELETE
+
+    def __init__ (self, file_names) :
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL (ctypes.util.find_library ("c"), use_errno = True)
+        self.inotify_fd = self.libc.inotify_init1 (os.O_CLOEXEC)
+        if self.inotify_fd < 0 :
+            raise OSError (ctypes.get_errno (), "inotify_init1 failed")
+        self.file_names = set (file_names)
+        self.watch_dirs = {}        # watch descriptor : directory
+        for _, dir_name in enumerate ({os.path.dirname (file_name) for file_name in self.file_names}) :
+            watch_id = self.libc.inotify_add_watch (self.inotify_fd ,
+                                                    os.fsencode (dir_name) ,
+                                                    self.EVENT_MASK)
+            if watch_id < 0 :
+                self.close ()
+                raise OSError (ctypes.get_errno (), "inotify_add_watch failed: " + dir_name)
+            self.watch_dirs [watch_id] = dir_name
+
+    def wait_changes (self, timeout : float = None) -> set :
+        ready, _, _ = select.select ([self.inotify_fd], [], [], timeout)
+        changed = set ()
+        if len (ready) <= 0 :
+            return changed
+        event_data = os.read (self.inotify_fd, 65536)
+        event_idx = 0
+        while event_idx + 16 <= len (event_data) :
+            watch_id, _, _, name_len = struct.unpack_from ("iIII", event_data, event_idx)
+            name = event_data [event_idx + 16:event_idx + 16 + name_len].rstrip (b"\0")
+            event_idx += 16 + name_len
+            dir_name = self.watch_dirs.get (watch_id)
+            if dir_name is None :
+                continue
+            file_name = os.path.join (dir_name, os.fsdecode (name))
+            if file_name in self.file_names :
+                changed.add (file_name)
+        return changed
+
+    def close (self) :
+        if self.inotify_fd >= 0 :
+            os.close (self.inotify_fd)
+            self.inotify_fd = -1
+
+def get_watcher (file_names, use_inotify : bool = True) :
+    if use_inotify \
+    and sys.platform.startswith ("linux") :
+        try :
+            return InotifyWatcher (file_names)
+        except (OSError, AttributeError) :
+            pass                    # no inotify, poll
+    return PollingWatcher (file_names)
+
+# Regenerate the devices whose input files change. A config file change
+# regenerates all devices. Generation is incremental, only changed output
+# files are written. Changes are collected until none arrive for debounce
+# seconds (editor save bursts).
+def watch_config (config_file_name : str ,
+                  workers : int = None ,
+                  output_dir : str = None ,
+                  use_inotify : bool = True ,
+                  debounce : float = 0.3) :
+    # a bad edit is reported and watching goes on with the last good config
+    def watch_generate_device (device) :
+        try :
+            generate_device (device, base_dir, output, workers, True)
+        except Exception as error :
+            print ("Device error:", device.get ("package"), error)
+    config_path = os.path.abspath (config_file_name)
+    reload_config = True
+    changed = set ()
+    watcher = None
+    base_dir = None
+    output = None
+    devices = []
+    device_inputs = []
+    try :
+        while True :
+            if reload_config :
+                reload_config = False
+                try :
+                    config, new_base_dir = load_config (config_path)
+                    new_output = get_config_output (config, new_base_dir, output_dir)
+                    new_devices = config.get ("devices") or []
+                    new_device_inputs = [get_device_inputs (device, new_base_dir)
+                                         for device in new_devices]
+                except Exception as error :
+                    print ("Config error:", config_path, error)
+                else :
+                    if workers is None :
+                        workers = config.get ("workers")
+                    base_dir = new_base_dir
+                    output = new_output
+                    devices = new_devices
+                    device_inputs = new_device_inputs
+                    for _, device in enumerate (devices) :
+                        watch_generate_device (device)
+                if watcher is not None :
+                    watcher.close ()
+                watch_files = {config_path}
+                for _, input_files in enumerate (device_inputs) :
+                    watch_files |= input_files
+                watcher = get_watcher (watch_files, use_inotify)
+                print ("Watching", len (watch_files), "files")
+            changed |= watcher.wait_changes (None)
+            # debounce
+            while True :
+                more_changes = watcher.wait_changes (debounce)
+                if len (more_changes) <= 0 :
+                    break
+                changed |= more_changes
+            if config_path in changed :
+                changed = set ()
+                reload_config = True
+                continue
+            for device_idx, device in enumerate (devices) :
+                if len (device_inputs [device_idx] & changed) > 0 :
+                    watch_generate_device (device)
+            changed = set ()
+    except KeyboardInterrupt :
+        pass
+    finally :
+        if watcher is not None :
+            watcher.close ()
+
 #
 ################################################################################
 # main
 ################################################################################
 
 def main () :
+    parser = argparse.ArgumentParser (prog = "python -m ha_yaml_gen" ,
+                                      description = "Generate HA yaml packages for the devices in a config file. "
+                                                    "Without a config file an example weather package is generated.")
+    parser.add_argument ("config", nargs = "?", help = "device config yaml file")
+    parser.add_argument ("--workers", type = int, default = None ,
+                         help = "worker processes per device")
+    parser.add_argument ("--incremental", action = "store_true", default = None ,
+                         help = "only write changed files")
+    parser.add_argument ("--output-dir", default = None ,
+                         help = "output directory, default config output_dir")
+    parser.add_argument ("--watch", action = "store_true" ,
+                         help = "keep running, regenerate devices when their input files change")
+    parser.add_argument ("--poll", action = "store_true" ,
+                         help = "watch by polling instead of inotify")
+    args = parser.parse_args ()
+    if args.config is None :
+        weather_example ()
+        return
+    if args.watch :
+        watch_config (args.config ,
+                      workers = args.workers ,
+                      output_dir = args.output_dir ,
+                      use_inotify = not args.poll)
+        return
+    run_config (args.config ,
+                workers = args.workers ,
+                incremental = args.incremental ,
+                output_dir = args.output_dir)
+
+def weather_example () :
 
     # Output from Pimironi enviro outdoor weather sensors
     # JSON text edited for readability